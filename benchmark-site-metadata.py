@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of update-site-metadata.py
+#
+# Generates synthetic galleries, runs the script on them in cold (nothing
+# generated yet), warm (nothing changed) and changed (one original changed)
+# cases and collects phase timings from the run report of every run.
+# Results are stored per git commit, so runs of different commits can be
+# compared and slowdowns are reported.
+
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Install package python-pillow
+try:
+	from PIL import Image
+	from PIL import ImageDraw
+except ImportError:
+	print('Cannot import Python\'s PIL module.')
+	print('Install package "python-pillow" or similar and try again.')
+	exit(10)
+
+import json
+
+#***** Constants
+
+#** Locations, the same as in update-site-metadata.py
+SiteData = 'site-data'
+SiteMetaData = 'site-metadata'
+Galleries = 'galleries'
+RunReportFile = '.run-report.json'
+
+ScriptDir = os.path.dirname(os.path.abspath(__file__))
+DefaultScript = os.path.join(ScriptDir, 'update-site-metadata.py')
+DefaultResults = os.path.join(ScriptDir, '.benchmark-results.json')
+
+#** Gallery shapes
+# Key: shape name
+# Value: (galleries, items per gallery, ratio of videos, ratio of audio files)
+GalleryShapes = {
+	'many-small': (100, 5, 0.0, 0.0),
+	'few-huge': (2, 300, 0.0, 0.0),
+	'mixed': (10, 20, 0.1, 0.1),
+}
+
+#** Synthetic media
+ImageSize = (2400, 1600)
+VideoSize = (1280, 720)
+VideoDuration = 5 # Seconds
+AudioDuration = 30 # Seconds
+
+#** Benchmark
+Cases = [ 'cold', 'warm', 'changed' ]
+Phases = [ 'scan', 'manifest', 'rss', 'json', 'media' ]
+RegressionRatio = 1.10 # Slowdown reported when phase takes 10 % longer...
+RegressionMinTime = 0.05 # ...and at least this many seconds longer
+
+#** Tools
+ToolFFmpeg = 'ffmpeg'
+
+#** Logging
+LogTag = 'Benchmark'
+def logE(message):
+	print(LogTag + ' (E): ' + message, file = sys.stderr)
+def logW(message):
+	print(LogTag + ' (W): ' + message)
+def logI(message):
+	print(LogTag + ' (I): ' + message)
+
+#***** Synthetic galleries
+
+def createImage(filePath, baseImage, seed):
+	# Noise makes the compression ratio realistic, the rectangle makes every file unique
+	rnd = random.Random(seed)
+	image = baseImage.copy()
+	draw = ImageDraw.Draw(image)
+	x = rnd.randrange(image.width // 2)
+	y = rnd.randrange(image.height // 2)
+	draw.rectangle([ x, y, x + image.width // 4, y + image.height // 4 ],
+		fill = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+	image.save(filePath, quality = 90)
+
+def createVideo(filePath, seed):
+	subprocess.check_call([ ToolFFmpeg, '-y', '-hide_banner', '-loglevel', 'error',
+		'-f', 'lavfi', '-i', 'testsrc=duration={0}:size={1}x{2}:rate=25'.format(VideoDuration, VideoSize[0], VideoSize[1]),
+		'-f', 'lavfi', '-i', 'sine=frequency={0}:duration={1}'.format(220 + seed % 880, VideoDuration),
+		'-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', filePath ])
+
+def createAudio(filePath, seed):
+	subprocess.check_call([ ToolFFmpeg, '-y', '-hide_banner', '-loglevel', 'error',
+		'-f', 'lavfi', '-i', 'sine=frequency={0}:duration={1}'.format(220 + seed % 880, AudioDuration),
+		'-c:a', 'libmp3lame', filePath ])
+
+def generateGalleries(rootDir, shape, scale):
+	galleryCount, itemCount, videoRatio, audioRatio = GalleryShapes[shape]
+	galleryCount = max(1, round(galleryCount * scale))
+	itemCount = max(1, round(itemCount * scale))
+	rnd = random.Random(shape)
+	baseImage = Image.merge('RGB', [ Image.effect_noise(ImageSize, 64) for band in range(3) ])
+	haveFFmpeg = shutil.which(ToolFFmpeg) is not None
+	if not haveFFmpeg and (videoRatio > 0 or audioRatio > 0):
+		logW('Tool "{0}" not found, only images are generated'.format(ToolFFmpeg))
+	for galleryNum in range(1, galleryCount + 1):
+		galleryDir = os.path.join(rootDir, SiteData, Galleries, '{0:03d}-Gallery {0}'.format(galleryNum))
+		os.makedirs(galleryDir)
+		for itemNum in range(1, itemCount + 1):
+			seed = galleryNum * 10000 + itemNum
+			fileBase = os.path.join(galleryDir, '{0:03d}-bench-Item {0}'.format(itemNum))
+			kind = rnd.random()
+			if haveFFmpeg and kind < videoRatio:
+				createVideo(fileBase + '.mp4', seed)
+			elif haveFFmpeg and kind < videoRatio + audioRatio:
+				createAudio(fileBase + '.mp3', seed)
+			else:
+				createImage(fileBase + '.jpg', baseImage, seed)
+	logI('Generated {0} galleries with {1} items each ("{2}")'.format(galleryCount, itemCount, shape))
+	return baseImage
+
+def changeOneOriginal(rootDir, baseImage, seed):
+	# The first image of the first gallery gets new content
+	galleriesDir = os.path.join(rootDir, SiteData, Galleries)
+	galleryDir = os.path.join(galleriesDir, sorted(os.listdir(galleriesDir))[0])
+	for fileName in sorted(os.listdir(galleryDir)):
+		if fileName.endswith('.jpg'):
+			createImage(os.path.join(galleryDir, fileName), baseImage, seed)
+			return
+	logW('No image to change found in "{0}"'.format(galleryDir))
+
+#***** Benchmark runs
+
+def runScript(script, rootDir):
+	# Returns phases' wall times from run report, total wall time included as 'total'
+	wallStart = time.monotonic()
+	with open(os.path.join(rootDir, 'update-site-metadata.log'), 'a') as logFile:
+		subprocess.check_call([ sys.executable, script, '--all' ], cwd = rootDir,
+			stdout = logFile, stderr = subprocess.STDOUT)
+	wallTime = time.monotonic() - wallStart
+	with open(os.path.join(rootDir, SiteMetaData, RunReportFile), 'r') as f:
+		report = json.load(f)
+	times = { phase['name']: phase['wallTime'] for phase in report['phases'] }
+	times['total'] = round(wallTime, 3)
+	return times
+
+def benchmarkShape(script, rootDir, shape, scale, repeat):
+	# Returns dictionary case -> phase -> median wall time
+	baseImage = generateGalleries(rootDir, shape, scale)
+	os.symlink(os.path.join(os.path.dirname(os.path.abspath(script)), 'images'), os.path.join(rootDir, 'images'))
+	samples = { case: [] for case in Cases }
+	for iteration in range(repeat):
+		shutil.rmtree(os.path.join(rootDir, SiteMetaData), ignore_errors = True)
+		samples['cold'].append(runScript(script, rootDir))
+		samples['warm'].append(runScript(script, rootDir))
+		changeOneOriginal(rootDir, baseImage, -1 - iteration)
+		samples['changed'].append(runScript(script, rootDir))
+	results = {}
+	for case in Cases:
+		results[case] = {}
+		for phase in samples[case][0]:
+			results[case][phase] = round(statistics.median([ sample.get(phase, 0) for sample in samples[case] ]), 3)
+		logI('{0}/{1}: {2}'.format(shape, case, ', '.join([ '{0} {1} s'.format(phase, time)
+			for phase, time in results[case].items() ])))
+	return results
+
+def gitCommit(script):
+	# Returns short hash of commit the script comes from, '-dirty' appended for local changes
+	scriptDir = os.path.dirname(os.path.abspath(script))
+	try:
+		commit = subprocess.check_output([ 'git', 'rev-parse', '--short', 'HEAD' ], cwd = scriptDir,
+			universal_newlines = True).strip()
+		changes = subprocess.check_output([ 'git', 'status', '--porcelain', '--untracked-files=no' ], cwd = scriptDir,
+			universal_newlines = True).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+	return commit + ('-dirty' if changes != '' else '')
+
+#***** Results
+
+def loadResults(filePath):
+	try:
+		with open(filePath, 'r') as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return []
+
+def storeResults(filePath, results):
+	with open(filePath + '.tmp', 'w') as f:
+		json.dump(results, f, indent = 1, sort_keys = True)
+	os.replace(filePath + '.tmp', filePath)
+	logI('Results stored to "{0}"'.format(filePath))
+
+def compareResults(previous, current):
+	# Returns number of slower phases
+	logI('Comparing commit {0} to {1}:'.format(current['commit'], previous['commit']))
+	regressions = 0
+	for shape in sorted(current['shapes']):
+		for case in Cases:
+			try:
+				before = previous['shapes'][shape][case]
+			except KeyError:
+				continue
+			after = current['shapes'][shape][case]
+			for phase in Phases + [ 'total' ]:
+				if phase not in before or phase not in after:
+					continue
+				slower = after[phase] > before[phase] * RegressionRatio and after[phase] - before[phase] > RegressionMinTime
+				if slower:
+					regressions += 1
+				message = '    {0}/{1}/{2}: {3} s -> {4} s'.format(shape, case, phase, before[phase], after[phase])
+				if slower:
+					logW(message + ' SLOWER')
+				else:
+					logI(message)
+	return regressions
+
+#***** Main
+
+ArgShape = '--shape'
+ArgScale = '--scale'
+ArgRepeat = '--repeat'
+ArgScript = '--script'
+ArgResults = '--results'
+ArgKeep = '--keep'
+
+def displayHelp():
+	print('Usage:')
+	print('  ' + sys.argv[0] + ' [options]')
+	print('')
+	print('Options:')
+	print('  ' + ArgShape + ' NAME')
+	print('    Benchmark only given gallery shape, can be repeated.')
+	print('    Shapes: ' + ', '.join(sorted(GalleryShapes)) + ' (all by default).')
+	print('  ' + ArgScale + ' FACTOR')
+	print('    Multiply number of galleries and items of shapes (1 by default).')
+	print('  ' + ArgRepeat + ' N')
+	print('    Run every case N times and take median (1 by default).')
+	print('  ' + ArgScript + ' PATH')
+	print('    Script to benchmark (update-site-metadata.py next to this one by default).')
+	print('  ' + ArgResults + ' PATH')
+	print('    File results are appended to (' + DefaultResults + ' by default).')
+	print('  ' + ArgKeep)
+	print('    Keep generated web roots in temporary folder.')
+	print('')
+	print('Results of the same commit are replaced, the last result of other')
+	print('commit is compared and slower phases are reported with exit code 1.')
+
+if __name__ == '__main__':
+	argShapes = []
+	argScale = 1.0
+	argRepeat = 1
+	argScript = DefaultScript
+	argResults = DefaultResults
+	argKeep = False
+
+	args = sys.argv[1:]
+	try:
+		while len(args) > 0:
+			arg = args.pop(0)
+			if arg == '-h' or arg == '--help':
+				displayHelp()
+				exit(0)
+			if arg == ArgShape:
+				shape = args.pop(0)
+				if shape not in GalleryShapes:
+					logE('Unknown shape "{0}"'.format(shape))
+					exit(1)
+				argShapes.append(shape)
+				continue
+			if arg == ArgScale:
+				argScale = float(args.pop(0))
+				continue
+			if arg == ArgRepeat:
+				argRepeat = max(1, int(args.pop(0)))
+				continue
+			if arg == ArgScript:
+				argScript = args.pop(0)
+				continue
+			if arg == ArgResults:
+				argResults = args.pop(0)
+				continue
+			if arg == ArgKeep:
+				argKeep = True
+				continue
+			logE('Unknown argument "{0}"'.format(arg))
+			displayHelp()
+			exit(1)
+	except (IndexError, ValueError):
+		logE('Missing or invalid value of argument "{0}"'.format(arg))
+		exit(1)
+	if len(argShapes) == 0:
+		argShapes = sorted(GalleryShapes)
+
+	current = {}
+	current['commit'] = gitCommit(argScript)
+	current['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+	current['cpuCount'] = os.cpu_count()
+	current['scale'] = argScale
+	current['shapes'] = {}
+	logI('Benchmarking commit {0}'.format(current['commit']))
+	for shape in argShapes:
+		rootDir = tempfile.mkdtemp(prefix = 'benchmark-' + shape + '-')
+		try:
+			current['shapes'][shape] = benchmarkShape(argScript, rootDir, shape, argScale, argRepeat)
+		except subprocess.CalledProcessError as ex:
+			logE('Benchmark of "{0}" failed ({1}), see "{2}"'.format(shape, str(ex),
+				os.path.join(rootDir, 'update-site-metadata.log')))
+			exit(2)
+		if argKeep:
+			logI('Web root kept in "{0}"'.format(rootDir))
+		else:
+			shutil.rmtree(rootDir, ignore_errors = True)
+
+	results = loadResults(argResults)
+	previous = [ result for result in results if result['commit'] != current['commit'] ]
+	# Results of different scale are not comparable
+	previous = [ result for result in previous if result.get('scale', 1.0) == current['scale'] ]
+	results = [ result for result in results if result['commit'] != current['commit'] ]
+	results.append(current)
+	storeResults(argResults, results)
+	if len(previous) > 0 and compareResults(previous[-1], current) > 0:
+		exit(1)
@@ -37,6 +37,10 @@ define([
 		url: function() {
 			return '/site-metadata/galleries/' + this.galleryId + '.json';
 		},
+		indexUrl: function() {
+			// Index of gallery stored in pages, see GalleryPageSize in update script
+			return '/site-metadata/galleries/' + this.galleryId + '.index.json';
+		},
 	});
 
 	return GalleryCollection;
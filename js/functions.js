@@ -33,6 +33,7 @@ function toIntStrict(string, defaultValue, radix) {
 }
 
 function onThumbnailLoadError(image) {
+	$(image).parent('picture').children('source').remove(); // Would take precedence over src
 	$(image).attr({
 		src: '/images/gallery/not-available.thumbnail.jpg',
 		width: 200,
@@ -40,7 +41,9 @@ function onThumbnailLoadError(image) {
 	});
 }
 function onPosterLoadError(image) {
+	$(image).parent('picture').children('source').remove(); // Would take precedence over src
 	$(image).attr({
+		srcset: null, // Would take precedence over src
 		src: '/images/gallery/not-available.poster.jpg',
 		width: 320,
 		height: 180
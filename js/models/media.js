@@ -35,12 +35,18 @@ define([
 				path: '', // URL encoded path
 				width: 0,
 				height: 0,
+				alternatives: [], // Other image formats, objects with path, type (MIME type) and bytes
 			},
 			poster: {
 				path: '', // URL encoded path
 				width: 0,
 				height: 0,
+				alternatives: [], // Other image formats, objects with path, type (MIME type) and bytes
 			},
+			posters: [], // Posters of different sizes (including poster), objects like poster
+			sprite: null, // Thumbnail position in sprite sheet, object with path, x and y
+			stream: '', // URL encoded path to HLS master playlist of video or empty string
+			placeholder: '', // Tiny blurry image (data URI) shown while thumbnail or poster is loading
 			galleryId: '0', // Number as string
 			galleryTitle: '',
 		},
@@ -143,23 +143,10 @@ define([
 				var selector = '#gallery' + galleryId;
 				var showGallery = function(itemId) {
 					if (itemIdValid) {
-						var selector = '#galleryOverlay';
-						if (galleryOverlayView == null) {
-							var options = {
-								el: selector,
-								onReady: function() {
-									G_initSubPage(galleryViews[galleryId].$el);
-									galleryOverlayView.show(galleryViews[galleryId], itemId);
-								},
-								onError: function() {
-									galleryOverlayView.hide();
-								},
-							};
-							galleryOverlayView = new GalleryOverlayView(options);
-						}
-						else {
-							galleryOverlayView.show(galleryViews[galleryId], itemId);
-						}
+						// Item may be on page of gallery not loaded yet
+						galleryViews[galleryId].loadItem(itemId, function() {
+							showGalleryOverlay(itemId);
+						});
 					}
 					else {
 						if (itemId != null && itemId != '') {
@@ -167,6 +154,25 @@ define([
 						}
 					}
 				};
+				var showGalleryOverlay = function(itemId) {
+					var selector = '#galleryOverlay';
+					if (galleryOverlayView == null) {
+						var options = {
+							el: selector,
+							onReady: function() {
+								G_initSubPage(galleryViews[galleryId].$el);
+								galleryOverlayView.show(galleryViews[galleryId], itemId);
+							},
+							onError: function() {
+								galleryOverlayView.hide();
+							},
+						};
+						galleryOverlayView = new GalleryOverlayView(options);
+					}
+					else {
+						galleryOverlayView.show(galleryViews[galleryId], itemId);
+					}
+				};
 				if (typeof galleryViews[galleryId] === 'undefined') {
 					$('.main-container .tab-content').append(
 						$('<div>')
@@ -101,24 +101,71 @@ define([
 			var height = currentItemPoster.height;
 			var base = 'site-metadata/' + url;
 			var type = currentItem.get('type');
+			var placeholder = currentItem.get('placeholder');
+			var placeholderCss = (placeholder != '')
+				? { background: 'url(\'' + placeholder + '\') center/contain no-repeat' }
+				: {};
 
 			switch (type) {
 				case 'Image': {
-					this.$mediaContainer.html($('<img>')
+					// Let browser choose poster according to screen size and density
+					// and the best image format it supports
+					var posters = currentItem.get('posters');
+					var srcset = _.map(posters, function(poster) {
+						return '/' + poster.path + ' ' + poster.width + 'w';
+					}).join(', ');
+					var alternativeSrcsets = {}; // Key: MIME type, value: srcset
+					var alternativeTypes = [];
+					_.each(posters, function(poster) {
+						_.each(poster.alternatives || [], function(alternative) {
+							if (typeof alternativeSrcsets[alternative.type] == 'undefined') {
+								alternativeSrcsets[alternative.type] = [];
+								alternativeTypes.push(alternative.type);
+							}
+							alternativeSrcsets[alternative.type].push('/' + alternative.path + ' ' + poster.width + 'w');
+						});
+					});
+					var $picture = $('<picture>');
+					_.each(alternativeTypes, function(type) {
+						$picture.append($('<source>')
+							.attr({
+								type: type,
+								srcset: alternativeSrcsets[type].join(', '),
+								sizes: '100vw',
+							})
+						);
+					});
+					this.$mediaContainer.html($picture.append($('<img>')
 						.addClass('media')
 						.addClass('img-fluid')
 						.addClass('object-fit-scale-down')
+						.css(placeholderCss)
 						.attr({
 							onerror: 'onPosterLoadError(this)',
+							onload: 'this.style.background = \'\'',
 							width: width,
 							height: height,
 							src: '/' + currentItemPoster.path,
+							srcset: (srcset != '') ? srcset : null,
+							sizes: '100vw',
 						})
-					);
+					));
 					break;
 				}
 				case 'Video': {
-					this.$mediaContainer.html($('<video>')
+					var $video = $('<video>');
+					var stream = currentItem.get('stream');
+					if (stream != '') {
+						// Adaptive stream goes first, browsers without native
+						// HLS support skip it by its type
+						$video.append($('<source>')
+							.attr({
+								type: 'application/vnd.apple.mpegurl',
+								src: '/' + stream,
+							})
+						);
+					}
+					this.$mediaContainer.html($video
 						.addClass('media')
 						.addClass('img-fluid')
 						.addClass('object-fit-scale-down')
@@ -130,7 +177,7 @@ define([
 							height: height,
 							poster: '/' + currentItemPoster.path,
 						})
-						// mp4 source has to be first to work on iPad
+						// mp4 source has to be first of progressive files to work on iPad
 						.append($('<source>')
 							.attr({
 								//type: 'video/mp4; codecs=\'avc1, mp4a\'',
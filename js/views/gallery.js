@@ -25,9 +25,11 @@ define([
 	'backbone',
 	'collections/gallery',
 	'text!templates/gallery.html',
-], function($, _, Backbone, GalleryCollection, galleryTemplate) {
+	'text!templates/gallery-items.html',
+], function($, _, Backbone, GalleryCollection, galleryTemplate, galleryItemsTemplate) {
 	var GalleryView = Backbone.View.extend({
 		template: _.template(galleryTemplate), // Class variable (not per-instance variable)
+		itemsTemplate: _.template(galleryItemsTemplate), // Class variable (not per-instance variable)
 		initialize: function(options) {
 			this.options = options;
 			if (options.galleryId == '') {
@@ -40,12 +42,106 @@ define([
 				tags: {}, // Associative array, key: tag name, value: tag's occurences
 			};
 
+			this.itemsCount = 0;
+			this.pages = []; // Pages of items not loaded yet
+			this.loadingPage = false;
+
+			// Small galleries are stored whole, large ones in pages loaded on scroll
 			this.collection = new GalleryCollection({ galleryId: this.gallery.id });
 			this.collection.fetch({
 				reset: true,
 				success: $.proxy(this.collectionSuccess, this),
-				error: $.proxy(this.collectionError, this),
+				error: $.proxy(this._fetchIndex, this),
+			});
+		},
+		_fetchIndex: function() {
+			$.ajax({
+				url: this.collection.indexUrl(),
+				dataType: 'json',
+				success: $.proxy(this.indexSuccess, this),
+				error: $.proxy(function() {
+					this.collectionError(this.collection);
+				}, this),
+			});
+		},
+		indexSuccess: function(index) {
+			this.gallery.title = index.title;
+			var sortedKeys = Object.keys(index.tags).sort();
+			_.each(sortedKeys, $.proxy(function(key) {
+				this.gallery.tags[key] = index.tags[key];
+			}, this));
+			this.itemsCount = index.count;
+			this.pages = index.pages.slice();
+			// First page is rendered together with the rest of gallery
+			if (!this._loadNextPage($.proxy(this.render, this))) {
+				this.render();
+			}
+		},
+		_loadNextPage: function(onLoaded) {
+			// Returns false when there is no page to load or other page is being loaded
+			if (this.pages.length == 0 || this.loadingPage) {
+				return false;
+			}
+			this.loadingPage = true;
+			var page = this.pages[0];
+			$.ajax({
+				url: '/' + page.path,
+				dataType: 'json',
+				success: $.proxy(function(items) {
+					this.pages.shift();
+					this.loadingPage = false;
+					var models = this.collection.add(items);
+					if (this.$filter) {
+						// Already rendered, append items
+						this.$('.gallery-thumbnails').append(this.itemsTemplate({
+							galleriesPath: this._galleriesPath(),
+							gallery: this.gallery,
+							items: _.map(models, function(model) { return model.toJSON(); }),
+						}));
+						this._updateItemsVisibility();
+					}
+					if (onLoaded) {
+						onLoaded();
+					}
+				}, this),
+				error: $.proxy(function() {
+					// Failed page is dropped, callers would request it again and again
+					this.pages.shift();
+					this.loadingPage = false;
+					console.log('GalleryView: Cannot load page ' + page.path);
+					if (!this.$filter) {
+						// First page, gallery cannot be shown
+						this.pages = [];
+						this.collectionError(this.collection);
+						return;
+					}
+					if (onLoaded) {
+						onLoaded();
+					}
+				}, this),
 			});
+			return true;
+		},
+		_onScroll: function() {
+			// Load next page when less than two screens remain to the end of visible gallery
+			if (this.pages.length == 0 || !this.$el.hasClass('active')) {
+				return;
+			}
+			var windowHeight = $(window).height();
+			if ($(window).scrollTop() + 3 * windowHeight > $(document).height()) {
+				this._loadNextPage($.proxy(this._onScroll, this));
+			}
+		},
+		loadItem: function(itemId, onLoaded) {
+			// Loads pages up to the one containing given item, IDs are sorted
+			// as strings by update script
+			var page = this.pages[0];
+			if (this.collection.get(itemId) || !page || String(itemId) < String(page.firstId)) {
+				onLoaded();
+			}
+			else if (!this._loadNextPage($.proxy(this.loadItem, this, itemId, onLoaded))) {
+				setTimeout($.proxy(this.loadItem, this, itemId, onLoaded), 100); // Other page is being loaded
+			}
 		},
 		collectionError: function(collection) {
 			delete this.collection;
@@ -72,6 +168,7 @@ define([
 			_.each(sortedKeys, $.proxy(function(key) {
 				this.gallery.tags[key] = tags[key];
 			}, this));
+			this.itemsCount = collection.length;
 			this.render();
 		},
 		_activate: function() {
@@ -86,8 +183,22 @@ define([
 			}, this));
 			this.$filterCounterVisible = this.$filter.find('.filter-counter .filter-visible');
 			this.$filterCounterTotal = this.$filter.find('.filter-counter .filter-total');
-			this.$filterCounterTotal.html(this.collection.length);
+			this.$filterCounterTotal.html(this.itemsCount);
 			this._updateItemsVisibility();
+			$(window).off(this._windowEvents());
+			if (this.pages.length > 0) {
+				$(window).on(this._windowEvents(), _.throttle($.proxy(this._onScroll, this), 200));
+				setTimeout($.proxy(this._onScroll, this), 0); // Fill screen when first page is too short
+			}
+		},
+		_windowEvents: function() {
+			// Window events namespaced per gallery, unbound when view is removed
+			var namespace = '.gallery' + this.gallery.id;
+			return 'scroll' + namespace + ' resize' + namespace;
+		},
+		remove: function() {
+			$(window).off(this._windowEvents());
+			return Backbone.View.prototype.remove.apply(this, arguments);
 		},
 		_checkAllFilterTags: function() {
 			this.$filter.find('.filter-tags .filter-tag').addClass('active');
@@ -155,9 +266,16 @@ define([
 			}, this));
 			this.$filterCounterVisible.html(this.collection.where({ visible: true }).length);
 		},
+		_galleriesPath: function() {
+			return (Backbone.history._hasPushState) ? 'galleries' : '#galleries';
+		},
 		render: function() {
-			var galleriesPath = (Backbone.history._hasPushState) ? 'galleries' : '#galleries';
-			this.$el.html(this.template({ galleriesPath: galleriesPath, gallery: this.gallery, items: this.collection.toJSON() }));
+			this.$el.html(this.template({
+				galleriesPath: this._galleriesPath(),
+				gallery: this.gallery,
+				items: this.collection.toJSON(),
+				itemsTemplate: this.itemsTemplate,
+			}));
 			this._activate();
 			if (this.options.onReady) {
 				setTimeout(this.options.onReady, 0); // Run Asynchronously
@@ -0,0 +1,33 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+ScriptPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'update-site-metadata.py')
+
+def loadScript(dryRun):
+	# Script reads predefined resources from web root (repository) when loaded
+	previousFolder = os.getcwd()
+	os.chdir(os.path.dirname(ScriptPath))
+	try:
+		spec = importlib.util.spec_from_file_location('update_site_metadata', ScriptPath)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+	finally:
+		os.chdir(previousFolder)
+	module.argDryRun = dryRun # Normally set by main
+	return module
+
+class ScriptTestCase(unittest.TestCase):
+	# Runs every test with freshly loaded update script in empty web root
+	dryRun = False
+
+	def setUp(self):
+		self.usm = loadScript(self.dryRun)
+		self.previousFolder = os.getcwd()
+		self.folder = tempfile.TemporaryDirectory()
+		os.chdir(self.folder.name)
+
+	def tearDown(self):
+		os.chdir(self.previousFolder)
+		self.folder.cleanup()
@@ -0,0 +1,89 @@
+import os
+import unittest
+
+from PIL import Image
+
+from scripttest import ScriptTestCase
+
+class DeleteUnreferencedMediaTest(ScriptTestCase):
+	def setUp(self):
+		ScriptTestCase.setUp(self)
+		self.galleryPath = os.path.join(self.usm.SiteData, self.usm.Galleries, '001-Test')
+		os.makedirs(self.galleryPath)
+		for fileName in [ '001-One.jpg', '002-Two.jpg' ]:
+			self.addOriginal(fileName)
+		self.galleriesIn = self.scan()
+		for mediaItem in self.galleriesIn['001'].values():
+			self.addDerivatives(mediaItem)
+
+	def addOriginal(self, fileName):
+		Image.new('RGB', (300, 200), (200, 10, 10)).save(os.path.join(self.galleryPath, fileName))
+
+	def scan(self):
+		galleriesIn, galleryNames = self.usm.scanGalleriesIn()
+		return galleriesIn
+
+	def addDerivatives(self, mediaItem):
+		# Derivatives made by media generation, with manifest records
+		source = self.usm.cachedFingerprint(mediaItem['original'])
+		for fileName, params in self.usm.mediaDerivatives(mediaItem).values():
+			os.makedirs(os.path.dirname(fileName), exist_ok = True)
+			with open(fileName, 'wb') as f:
+				f.write(b'x' * 1000)
+			self.usm.manifestRecord(fileName, source, params)
+		return [ fileName for fileName, params in self.usm.mediaDerivatives(mediaItem).values() ]
+
+	def derivativeFileNames(self, itemId):
+		return [ fileName for fileName, params in self.usm.mediaDerivatives(self.galleriesIn['001'][itemId]).values() ]
+
+	def removeOriginal(self, fileName):
+		os.remove(os.path.join(self.galleryPath, fileName))
+		self.galleriesIn = self.scan()
+
+	def testDerivativesOfRemovedItemAreDeleted(self):
+		removedFileNames = self.derivativeFileNames('002')
+		self.removeOriginal('002-Two.jpg')
+		self.usm.deleteUnreferencedMedia(self.galleriesIn)
+		for fileName in removedFileNames:
+			self.assertFalse(os.path.lexists(fileName))
+			self.assertNotIn(fileName, self.usm.manifest)
+		for fileName in self.derivativeFileNames('001'):
+			self.assertTrue(os.path.isfile(fileName))
+			self.assertIn(fileName, self.usm.manifest)
+
+	def testItemAddedAfterScanIsKept(self):
+		# Other run adds original and creates its derivatives after this run scanned
+		self.addOriginal('003-Three.jpg')
+		addedFileNames = self.addDerivatives(self.scan()['001']['003'])
+		self.usm.deleteUnreferencedMedia(self.galleriesIn)
+		for fileName in addedFileNames:
+			self.assertTrue(os.path.isfile(fileName))
+
+	def testRemovedGalleryAndLeftoversAreDeleted(self):
+		removedGalleryPath = os.path.join(self.usm.SiteMetaData, self.usm.Galleries, '009')
+		os.makedirs(removedGalleryPath)
+		with open(os.path.join(removedGalleryPath, '001.thumbnail.jpg'), 'wb') as f:
+			f.write(b'x')
+		leftover = self.usm.temporaryFileName(self.derivativeFileNames('001')[0])
+		with open(leftover, 'wb') as f:
+			f.write(b'x')
+		self.usm.deleteUnreferencedMedia(self.galleriesIn)
+		self.assertFalse(os.path.lexists(removedGalleryPath))
+		self.assertFalse(os.path.lexists(leftover))
+
+	def testReferencedHardLinkSurvives(self):
+		# Derivative of kept item is linked to derivative of removed item (see linkDerivative())
+		removedFileName = self.derivativeFileNames('002')[0]
+		keptFileName = self.derivativeFileNames('001')[0]
+		os.remove(keptFileName)
+		os.link(removedFileName, keptFileName)
+		self.assertEqual(self.usm.reclaimedBytes([ removedFileName ]), 0)
+		self.assertEqual(self.usm.reclaimedBytes([ removedFileName, keptFileName ]), 1000)
+		self.removeOriginal('002-Two.jpg')
+		self.usm.deleteUnreferencedMedia(self.galleriesIn)
+		self.assertFalse(os.path.lexists(removedFileName))
+		self.assertEqual(os.stat(keptFileName).st_nlink, 1)
+		self.assertEqual(os.path.getsize(keptFileName), 1000)
+
+if __name__ == '__main__':
+	unittest.main()
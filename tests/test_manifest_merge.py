@@ -0,0 +1,54 @@
+import json
+import os
+import unittest
+
+from scripttest import ScriptTestCase, loadScript
+
+class ManifestMergeTest(ScriptTestCase):
+	def setUp(self):
+		ScriptTestCase.setUp(self)
+		self.other = loadScript(False) # Concurrent run
+		self.manifestPath = os.path.join(self.usm.SiteMetaData, self.usm.ManifestFile)
+		self.storeRecords(self.usm, [ 'kept', 'deleted' ])
+
+	def storeRecords(self, usm, fileNames):
+		for fileName in fileNames:
+			usm.manifestRecord(fileName, 'source', 'params')
+		usm.storeManifest()
+
+	def publishedFileNames(self):
+		with open(self.manifestPath, 'r') as f:
+			return sorted(json.load(f)['files'].keys())
+
+	def testRecordDeletedByOtherRunIsNotRestored(self):
+		# Other run deletes unreferenced media after this run loaded manifest
+		other = self.other
+		other.loadManifest()
+		del other.manifest['deleted']
+		other.manifestChanged = True
+		other.storeManifest()
+		self.storeRecords(self.usm, [ 'created' ])
+		self.assertEqual(self.publishedFileNames(), [ 'created', 'kept' ])
+		self.assertNotIn('deleted', self.usm.manifest)
+
+	def testRecordCreatedByOtherRunIsKept(self):
+		other = self.other
+		other.loadManifest()
+		self.storeRecords(other, [ 'other' ])
+		self.storeRecords(self.usm, [ 'created' ])
+		self.assertEqual(self.publishedFileNames(), [ 'created', 'deleted', 'kept', 'other' ])
+
+	def testRecordChangedByThisRunWins(self):
+		other = self.other
+		other.loadManifest()
+		del other.manifest['deleted']
+		other.manifestChanged = True
+		other.storeManifest()
+		# File is created again by this run
+		with open('deleted', 'w') as f:
+			f.write('deleted')
+		self.storeRecords(self.usm, [ 'deleted' ])
+		self.assertEqual(self.publishedFileNames(), [ 'deleted', 'kept' ])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,41 @@
+import os
+import unittest
+
+from PIL import Image
+
+from scripttest import ScriptTestCase
+
+class ThumbnailSpritesTest(ScriptTestCase):
+	dryRun = True
+
+	def setUp(self):
+		ScriptTestCase.setUp(self)
+		galleryPath = os.path.join(self.usm.SiteData, self.usm.Galleries, '001-Test')
+		os.makedirs(galleryPath)
+		for fileName in [ '001-One.jpg', '002-Two.jpg', 'photo.jpg' ]:
+			Image.new('RGB', (300, 200), (200, 10, 10)).save(os.path.join(galleryPath, fileName))
+		self.galleriesIn, self.galleryNames = self.usm.scanGalleriesIn()
+		# All derivatives are up to date
+		for mediaItem in self.galleriesIn['001'].values():
+			source = self.usm.cachedFingerprint(mediaItem['original'])
+			for fileName, params in self.usm.mediaDerivatives(mediaItem).values():
+				self.usm.manifest[fileName] = { 'source': source, 'params': params, 'bytes': 0 }
+
+	def testNonNumericItemHasNoSprite(self):
+		self.assertEqual(sorted(self.galleriesIn['001'].keys()), [ '001', '002', 'photo' ])
+		sprites = self.usm.thumbnailSprites('001', self.galleriesIn['001'])
+		self.assertEqual(len(sprites), 1)
+		digest, mediaItems = list(sprites.values())[0]
+		self.assertEqual([ mediaItem['id'] for mediaItem in mediaItems ], [ '001', '002' ])
+
+	def testNonNumericItemIsPublishedWithPlainThumbnail(self):
+		for fileName, (digest, mediaItems) in self.usm.thumbnailSprites('001', self.galleriesIn['001']).items():
+			self.usm.manifest[fileName] = { 'source': digest, 'params': None, 'bytes': 0 }
+		sprites = self.usm.itemSprites('001', self.galleriesIn['001'])
+		self.assertEqual(sorted(sprites.keys()), [ '001', '002' ])
+		publishedItem = self.usm.publishedMediaItem(self.galleriesIn['001']['photo'], sprites.get('photo'))
+		self.assertIsNone(publishedItem['sprite'])
+		self.assertEqual(publishedItem['thumbnail']['path'], os.path.join(self.usm.SiteMetaData, self.usm.Galleries, '001', 'photo.thumbnail.jpg'))
+
+if __name__ == '__main__':
+	unittest.main()
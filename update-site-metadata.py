@@ -4,27 +4,48 @@
 #import locale
 #locale.setlocale(locale.LC_ALL, 'cs_CZ')
 
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from email.utils import formatdate
+import asyncio
+import base64
 import concurrent.futures
+import contextlib
+import ctypes
 import datetime
+import fcntl
+import gzip
+import hashlib
+import heapq
 import html
+import io
 import os
 import re
+import resource
+import select
 import shutil
+import struct
 import subprocess
 import sys
+import threading
 import time
 import urllib.parse
 
 # Install package python-pillow
 try:
 	from PIL import Image
+	from PIL import features
 except ImportError:
 	print('Cannot import Python\'s PIL module.')
 	print('Install package "python-pillow" or similar and try again.')
 	exit(10)
 
+# Install package python-brotli (optional, only gzip compressed documents are
+# stored without it)
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
 # Install package python-simplejson
 try:
 	import json
@@ -48,6 +69,13 @@ SiteMetaData = 'site-metadata'
 #** Item types' locations
 Galleries = 'galleries'
 
+#** Internal state files (dot files are not served by Apache, see .htaccess)
+ProbeCacheFile = '.probe-cache.json'
+ManifestFile = '.manifest.json'
+JournalFile = '.journal'
+RunReportFile = '.run-report.json'
+LockFile = '.lock' # Held by media generation and deleting of unreferenced media
+
 #** Misc.
 MediaThumbnailSuffix = '.thumbnail'
 MediaPosterSuffix = '.poster'
@@ -65,54 +93,237 @@ MaxImagePosterHeight = 1000
 MaxVideoWidth = 640
 MaxVideoHeight = 640
 
+#** Responsive image posters
+# Max. sizes of additional image posters browsers choose from by screen size
+# (srcset), poster of MaxImagePosterWidth x MaxImagePosterHeight is always
+# created. Posters not smaller than original (the poster would be a full size
+# copy) and posters of the same size as other poster are omitted.
+ImagePosterLadder = [ (480, 320), (960, 640), (2400, 1600) ]
+
+#** Image formats
+# Key: file extension of image derivatives
+# Value: (Pillow format, MIME type, save options)
+ImageFormats = {
+	'jpg': ('JPEG', 'image/jpeg', {}),
+	'webp': ('WEBP', 'image/webp', { 'quality': 80, 'method': 4 }),
+	'avif': ('AVIF', 'image/avif', { 'quality': 60, 'speed': 6 }),
+}
+# Encoder profiles of JPEG thumbnails and posters (used also for the poster ladder)
+# Key: profile name ('thumbnail' or 'poster')
+# Value: dictionary with keys
+#     'quality': JPEG quality (1-95), the highest tried quality with 'maxBytes'
+#     'progressive', 'optimize': JPEG encoder options
+#     'subsampling': chroma subsampling ('4:4:4', '4:2:2' or '4:2:0')
+#     'stripMetadata': omit EXIF of original (color profile is always kept)
+#     'maxBytes': byte budget (for poster of MaxImagePosterWidth x
+#         MaxImagePosterHeight, scaled by area for the poster ladder), quality
+#         is lowered down to MinImageQuality to fit it, None for no budget
+ImageEncoderProfiles = {
+	'thumbnail': { 'quality': 80, 'progressive': False, 'optimize': True, 'subsampling': '4:2:0', 'stripMetadata': True, 'maxBytes': 16 * 1024 },
+	'poster': { 'quality': 85, 'progressive': True, 'optimize': True, 'subsampling': '4:2:0', 'stripMetadata': True, 'maxBytes': 300 * 1024 },
+}
+MinImageQuality = 40
+# Formats image thumbnails and posters are stored in besides JPEG (when
+# supported by installed Pillow), browsers choose the best one they support.
+# Older Pillow does not know 'avif' feature at all, features.check() would
+# warn about it on every start.
+ImageAlternativeFormats = [ fileExt for fileExt in [ 'avif', 'webp' ] if fileExt in features.get_supported_modules() ]
+
+#** Adaptive video streaming
+# Videos are stored also as HLS stream, folder '<id>.hls' with master playlist
+# and playlist plus segments of every rendition. All renditions are encoded by
+# the same ffmpeg run as other video formats (original is decoded only once),
+# renditions bigger than original are skipped. Set to empty list to not create
+# streams.
+VideoStreamLadder = [
+	# (max. width, max. height, video bitrate in bits per second)
+	(640, 360, 800000),
+	(1280, 720, 2500000),
+	(1920, 1080, 5000000),
+]
+VideoStreamAudioBitrate = 128000
+VideoStreamSegmentTime = 6 # Seconds, key frames of all renditions are aligned to segments
+VideoStreamFolderSuffix = '.hls'
+VideoStreamPlaylist = 'master.m3u8'
+
+#** Placeholders
+# Tiny JPEG images embedded in metadata (data URI) as placeholders of image
+# and video thumbnails and posters while they are loading
+PlaceholderSize = 16 # Max. width and height in pixels
+PlaceholderQuality = 40
+
+#** Gallery JSON pages
+# Galleries with more items than given number are stored as index document
+# '<id>.index.json' and pages '<id>.page-<n>.json' with given number of items,
+# browser loads pages on scroll. Smaller galleries are stored whole to
+# '<id>.json' (loaded by single request). Set to 0 to store all galleries whole.
+GalleryPageSize = 200
+
+#** Thumbnail sprites
+# Thumbnails of images and videos are packed to sprite sheets in folder
+# 'sprites' of every gallery, so gallery grid is loaded by few requests. Items
+# are put to sheets by their numeric IDs (ThumbnailSpriteSize IDs per sheet),
+# so only sheets with added, removed or changed items are re-created.
+ThumbnailSpriteSize = 50 # Set to 0 to not create sprite sheets
+ThumbnailSpriteColumns = 10
+ThumbnailSprites = 'sprites'
+
+#** Local staging (see argument --stage)
+# Originals are copied to local cache (named by their fingerprints, least
+# recently used are evicted over the limit) and outputs are written to local
+# staging folder, then pushed to site metadata folder in one sync phase.
+StageOriginals = '.originals' # Cache folder in staging folder
+StageCacheMaxBytes = 20 * 1024 * 1024 * 1024
+StageFetchThreads = 4 # Number of originals copied in parallel
+StageSyncThreads = 8 # Number of files pushed in parallel
+
+#** Watch mode (see argument --watch)
+WatchSettleTime = 10 # Seconds without changes before touched galleries are updated
+WatchMaxDelay = 300 # Max. seconds between first change and update, for long uploads
+WatchPollInterval = 60 # Seconds between scans when file system events are not used
+WatchPolling = False # Set to True for site data on network mounts (e.g. sshfs or NFS), inotify does not report changes made remotely
+
+#** Parallel processing
+MaxImageBatchSize = 16 # Max. number of images processed by one job
+ScanThreads = 8 # Number of galleries scanned in parallel
+CpuThreads = os.cpu_count() or 1 # Global budget of threads for media processing
+PillowWorkers = max(1, CpuThreads // 2) # Number of processes running image jobs
+DeleteThreads = 8 # Number of unreferenced files removed in parallel
+
 #***** Logging
 
 LogTag = 'TOMuvWeb'
 LogDebugMessages = False
 #LogDebugMessages = True
 
+ProgressLogInterval = 30 # Seconds between progress messages when not running in terminal
+
+progressLineShown = False
+
+def clearProgress():
+	global progressLineShown
+	if progressLineShown:
+		print('\r\x1b[K', end = '', file = sys.stderr, flush = True)
+		progressLineShown = False
+
 def logE(message):
+	clearProgress()
 	print(LogTag + ' (E): ' + message, file = sys.stderr)
 def logW(message):
+	clearProgress()
 	print(LogTag + ' (W): ' + message)
 def logI(message):
+	clearProgress()
 	print(LogTag + ' (I): ' + message)
 def logD(message):
 	if LogDebugMessages:
+		clearProgress()
 		print(LogTag + ' (D): ' + message)
+def logProgress(message):
+	# Progress is shown as single updated line in terminal, logged regularly otherwise
+	global progressLineShown
+	if sys.stderr.isatty():
+		sys.stdout.flush()
+		print('\r\x1b[K' + LogTag + ' (P): ' + message, end = '', file = sys.stderr, flush = True)
+		progressLineShown = True
+	else:
+		logI(message)
+
+#***** Run report
+# Wall time, CPU time (including child processes) and processed bytes are
+# recorded for every phase of the run and every media job. The report is
+# stored as JSON file in site metadata folder.
+
+RunReportVersion = 1
+
+def processCpuTime():
+	# CPU time of this process and all its finished child processes (tools, workers)
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return time.process_time() + children.ru_utime + children.ru_stime
+
+class RunReport:
+	def __init__(self):
+		self.started = time.time()
+		self.wallStart = time.monotonic()
+		self.cpuStart = processCpuTime()
+		self.phases = []
+		self.jobs = []
+		self.probe = { 'probed': 0, 'cached': 0, 'wallTime': 0.0 }
+		self.currentPhase = None
+		self.lock = threading.Lock() # Probing runs in scanner threads
+	@contextlib.contextmanager
+	def phase(self, name):
+		record = { 'name': name, 'wallTime': 0.0, 'cpuTime': 0.0, 'bytesIn': 0, 'bytesOut': 0 }
+		self.phases.append(record)
+		previousPhase = self.currentPhase
+		self.currentPhase = record
+		wallStart = time.monotonic()
+		cpuStart = processCpuTime()
+		try:
+			yield record
+		finally:
+			record['wallTime'] = round(time.monotonic() - wallStart, 3)
+			record['cpuTime'] = round(processCpuTime() - cpuStart, 3)
+			self.currentPhase = previousPhase
+			logD('Phase "{0}" finished in {1} s (CPU {2} s)'.format(name, record['wallTime'], record['cpuTime']))
+	def addBytes(self, bytesIn = 0, bytesOut = 0):
+		if self.currentPhase is not None:
+			self.currentPhase['bytesIn'] += bytesIn
+			self.currentPhase['bytesOut'] += bytesOut
+	def addProbe(self, probed, wallTime = 0.0):
+		with self.lock:
+			self.probe['probed' if probed else 'cached'] += 1
+			self.probe['wallTime'] += wallTime
+	def addJob(self, jobClass, mediaItem, fileNames, createdFileNames, jobStats):
+		record = {}
+		record['class'] = jobClass
+		record['original'] = mediaItem['original']
+		record['files'] = sorted(fileNames.values())
+		record['failed'] = sorted([ fileName for fileName in fileNames.values() if fileName not in createdFileNames ])
+		record['wallTime'] = round(jobStats['wallTime'], 3)
+		record['cpuTime'] = round(jobStats['cpuTime'], 3)
+		record['bytesIn'] = jobStats['bytesIn']
+		record['bytesOut'] = sum([ manifest[fileName]['bytes'] for fileName in createdFileNames if fileName in manifest ])
+		self.jobs.append(record)
+		self.addBytes(record['bytesIn'], record['bytesOut'])
+	def store(self):
+		data = {}
+		data['version'] = RunReportVersion
+		data['started'] = datetime.datetime.fromtimestamp(self.started).isoformat(timespec = 'seconds')
+		data['arguments'] = sys.argv[1:]
+		data['cpuCount'] = CpuThreads
+		data['wallTime'] = round(time.monotonic() - self.wallStart, 3)
+		data['cpuTime'] = round(processCpuTime() - self.cpuStart, 3)
+		data['phases'] = self.phases
+		data['probe'] = dict(self.probe, wallTime = round(self.probe['wallTime'], 3))
+		data['jobs'] = self.jobs
+		filePath = os.path.join(SiteMetaData, RunReportFile)
+		try:
+			os.makedirs(SiteMetaData, mode = 0o755, exist_ok = True)
+			writeFileAtomically(filePath, json.dumps(data, separators = (',', ':'), sort_keys = True, indent = 1))
+			logI('Run report stored to "{0}"'.format(filePath))
+		except Exception as ex:
+			logW('Cannot write run report "{0}" ({1})'.format(filePath, str(ex)))
+		for phase in self.phases:
+			logI('    {0}: {1} s (CPU {2} s)'.format(phase['name'], phase['wallTime'], phase['cpuTime']))
+
+runReport = RunReport()
 
 #***** Tools
 
 # Change to absolute path if your tools are not in PATH
-ToolConvert = 'convert'
-ToolComposite = 'composite'
 ToolFFmpeg = 'ffmpeg'
 ToolFFprobe = 'ffprobe'
-ToolIdentify = 'identify'
 
 def checkTools():
-	# Check convert binary
-	if shutil.which(ToolConvert) == 'None':
-		logE('Cannot find executable tool "{0}"'.format(ToolConvert))
-		logI('Install package "imagemagick" or similar and try again.')
-		return 11
-	# Check composite binary
-	if shutil.which(ToolComposite) == 'None':
-		logE('Cannot find executable tool "{0}"'.format(ToolComposite))
-		logI('Install package "imagemagick" or similar and try again.')
-		return 12
-	# Check identify binary
-	if shutil.which(ToolIdentify) == 'None':
-		logE('Cannot find executable tool "{0}"'.format(ToolIdentify))
-		logI('Install package "imagemagick" or similar and try again.')
-		return 13
+	# Images are processed in-process by Pillow, no ImageMagick tools needed
 	# Check ffmpeg binary
-	if shutil.which(ToolFFmpeg) == 'None':
+	if shutil.which(ToolFFmpeg) is None:
 		logE('Cannot find executable tool "{0}"'.format(ToolFFmpeg))
 		logI('Install package "ffmpeg" or similar and try again.')
 		return 14
 	# Check ffprobe binary
-	if shutil.which(ToolFFprobe) == 'None':
+	if shutil.which(ToolFFprobe) is None:
 		logE('Cannot find executable tool "{0}"'.format(ToolFFprobe))
 		logI('Install package "ffmpeg" or similar and try again.')
 		return 15
@@ -125,7 +336,10 @@ ArgRss = '--rss'
 ArgJson = '--json'
 ArgMedia = '--media'
 ArgAll = '--all'
-ArgDelete = '--delete-unreferenced-media' # TODO: Implement
+ArgVerbose = '--verbose'
+ArgStage = '--stage'
+ArgWatch = '--watch'
+ArgDelete = '--delete-unreferenced-media'
 
 def displayHelp():
 	print('')
@@ -153,15 +367,41 @@ def displayHelp():
 	print('    Generate JSON data for sub-pages in site metadata from existing')
 	print('    files in site metadata folder (output).')
 	print('    Output file is automatically overwritten.')
+	print('    Together with ' + ArgMedia + ' only items with thumbnails are published,')
+	print('    other galleries are published as soon as their thumbnails are created.')
 	print('  ' + ArgMedia)
 	print('    Generate media files in site metadata folder (output),')
 	print('    like image thumbnails, video in HTML5 supported formats,')
 	print('    pages, etc.')
-	print('    No output files are overwritten, only new files are created.')
-	print('    To re-generate any file delete it manually first.')
+	print('    Only missing or outdated files are (re-)created. File is outdated')
+	print('    when its original or encoding parameters have changed, see')
+	print('    manifest file "' + os.path.join(SiteMetaData, ManifestFile) + '".')
 	print('  ' + ArgAll)
 	print('    Combines all previous arguments: ' + ArgRss + ', ' + ArgJson + ' and ' + ArgMedia)
 	print('    together for convenience.')
+	print('  ' + ArgDelete)
+	print('    Delete files and folders in site metadata folder (output) that are not')
+	print('    referenced by any item in site data folder (input): media of removed')
+	print('    galleries and items, outdated derivatives and leftovers of interrupted')
+	print('    runs. Empty gallery folders are removed too. Together with ' + ArgDryRun)
+	print('    only the files and the number of bytes to free are printed out.')
+	print('    Nothing is deleted while other run creates media files. Use it together')
+	print('    with ' + ArgJson + ', otherwise published pages may refer to deleted files.')
+	print('  ' + ArgVerbose)
+	print('    Print out debug messages too.')
+	print('  ' + ArgStage + '=<folder>')
+	print('    Stage all work in given local folder, for site data and site metadata')
+	print('    on slow (e.g. sshfs) mounts. Originals are copied to a local cache')
+	print('    (' + str(StageCacheMaxBytes // (1024 * 1024)) + ' MiB at most, see StageCacheMaxBytes), outputs are')
+	print('    written to the local folder and pushed to site metadata folder at the')
+	print('    end of the run. Galleries are published at the end of the run then.')
+	print('  ' + ArgWatch)
+	print('    Keep running after the first run and update galleries as soon as their')
+	print('    folders in site data change (' + str(WatchSettleTime) + ' s after the last change, see')
+	print('    WatchSettleTime). Only outputs requested by other arguments are updated')
+	print('    and only for changed galleries. File system events are watched with')
+	print('    inotify, folders are polled every ' + str(WatchPollInterval) + ' s when it is not available')
+	print('    (or when WatchPolling is set, for network mounts). Stop with Ctrl+C.')
 	print('')
 	print('Warning:')
 	print('  Use either argument ' + ArgAll + ' or run with ' + ArgRss + ' and ' + ArgJson)
@@ -180,12 +420,13 @@ def displayHelp():
 Size = namedtuple('Size', 'width height')
 
 class ImageSrc(dict):
-	_keys = 'path width height'.split()
+	_keys = 'path width height alternatives'.split()
 	def __init__(self):
 		dict.__init__(self)
 		self['path'] = '' # String (file name with path relative to root folder)
 		self['width'] = 0 # Number in pixels
 		self['height'] = 0 # Number in pixels
+		self['alternatives'] = [] # Array of dictionaries with keys 'path', 'type' (MIME type) and 'bytes'
 	def __setitem__(self, key, value):
 		if key not in ImageSrc._keys:
 			raise KeyError
@@ -197,7 +438,7 @@ class ImageSrc(dict):
 		self['height'] = size.height
 
 class MediaItem(dict):
-	_keys = 'type id title tags original thumbnail poster galleryId galleryTitle'.split()
+	_keys = 'type id title tags original thumbnail poster posters sprite placeholder stream galleryId galleryTitle'.split()
 	def __init__(self):
 		dict.__init__(self)
 		self['type'] = '' # String 'Image', 'Video', 'Audio' or '' for undefined type
@@ -207,6 +448,10 @@ class MediaItem(dict):
 		self['original'] = '' # String (original file name with path relative to root folder)
 		self['thumbnail'] = ImageSrc()
 		self['poster'] = ImageSrc()
+		self['posters'] = [] # Array of ImageSrc sorted by width (including poster)
+		self['sprite'] = None # Dictionary with keys 'path', 'x' and 'y' (thumbnail position in sprite sheet) or None
+		self['placeholder'] = '' # String (data URI of tiny image) or '' when not available
+		self['stream'] = '' # String (path to HLS master playlist of video) or '' when not available
 		self['galleryId'] = '' # String containg a number
 		self['galleryTitle'] = ''
 	def __setitem__(self, key, value):
@@ -229,29 +474,61 @@ def mediaType(fileExt):
 	else:
 		return ''
 
-def mediaId(fileBase):
+def parseMediaName(fileBase):
 	# Gallery name format "INDEX-TITLE" (- escaped using --)
 	# Gallery item name format "INDEX-TAG-...-TAG-TITLE" (- escaped using --)
-	id = re.sub('--', '–', fileBase) # Pay attention to unicode en-dash character
+	# Returns (id, tags, title) tuple, name is split only once for all parts
+	name = fileBase.replace('--', '–') # Pay attention to unicode en-dash character
+	parts = name.split('-')
+	hasIndex = len(parts) > 1 and parts[0].isascii() and parts[0].isdigit()
 	# Take leading digits
-	id = re.sub(r'^([0-9]+)-.*$', r'\1', id)
-	return id
+	id = parts[0] if hasIndex else name
+	# Take substring after last dash
+	title = parts[-1]
+	# Remove leading digits and substring after last dash
+	tags = parts[1:-1] if hasIndex and len(parts) > 2 else parts
+	return id, tags, title
+
+def mediaId(fileBase):
+	return parseMediaName(fileBase)[0]
 
 def mediaTitle(fileBase):
-	# Gallery name format "INDEX-TITLE" (- escaped using --)
-	# Gallery item name format "INDEX-TAG-...-TAG-TITLE" (- escaped using --)
-	title = re.sub('--', '–', fileBase) # Pay attention to unicode en-dash character
-	# Take substring after last dash
-	title = re.sub(r'^.*-([^-]*)$', r'\1', title)
-	return title
+	return parseMediaName(fileBase)[2]
 
 def mediaTags(fileBase):
-	# Gallery item name format "INDEX-TAG-...-TAG-TITLE" (- escaped using --)
-	text = re.sub('--', '–', fileBase) # Pay attention to unicode en-dash character
-	# Remove leading digits and substring after last dash
-	text = re.sub(r'^[0-9]+-(.*)-[^-]*$', r'\1', text)
-	tags = text.split('-')
-	return tags
+	return parseMediaName(fileBase)[1]
+
+def probeInt(value):
+	# Returns integer value printed by ffprobe, None for 'N/A' or missing value
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+def probeStreams(filePath):
+	# Returns dictionary with keys 'format' (ffprobe format name) and 'bitrate'
+	# (overall, bits per second) of the container, 'videoCodec', 'videoBitrate',
+	# 'width' and 'height' of the first video stream (cover art is ignored) and
+	# 'audioCodec', 'audioBitrate' and 'audioChannels' of the first audio
+	# stream, values are None when unknown or stream is missing
+	stdout = subprocess.Popen([ ToolFFprobe, filePath, '-show_streams', '-show_format' ], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL).communicate()[0].decode('utf-8')
+	streams = { key: None for key in [ 'format', 'bitrate', 'videoCodec', 'videoBitrate', 'width', 'height', 'audioCodec', 'audioBitrate', 'audioChannels' ] }
+	for section, body in re.findall(r'^\[(STREAM|FORMAT)\]$(.*?)^\[/\1\]$', stdout, re.MULTILINE | re.DOTALL):
+		values = dict(re.findall(r'^([A-Za-z_:]+)=(.*)$', body, re.MULTILINE))
+		if section == 'FORMAT':
+			streams['format'] = values.get('format_name')
+			streams['bitrate'] = probeInt(values.get('bit_rate'))
+		elif values.get('codec_type') == 'video' and streams['videoCodec'] is None \
+				and values.get('DISPOSITION:attached_pic') != '1':
+			streams['videoCodec'] = values.get('codec_name')
+			streams['videoBitrate'] = probeInt(values.get('bit_rate'))
+			streams['width'] = probeInt(values.get('width'))
+			streams['height'] = probeInt(values.get('height'))
+		elif values.get('codec_type') == 'audio' and streams['audioCodec'] is None:
+			streams['audioCodec'] = values.get('codec_name')
+			streams['audioBitrate'] = probeInt(values.get('bit_rate'))
+			streams['audioChannels'] = probeInt(values.get('channels'))
+	return streams
 
 def mediaSize(filePath):
 	fileExt = os.path.splitext(filePath)[1]
@@ -259,25 +536,181 @@ def mediaSize(filePath):
 	width = 0
 	height = 0
 	if type == 'Image':
-		# ImageMagick's identify
-		#stdout = subprocess.Popen([ToolIdentify, '-format', '%wx%h', filePath], stdout = subprocess.PIPE).communicate()[0].decode('utf-8')
-		#width, height = [ int(x) for x in stdout.split('x') ]
-		# OR
-		#stdout = subprocess.check_output([ToolIdentify, '-format', '%wx%h', filePath], universal_newlines = True)
-		#width, height = [ int(x) for x in stdout.split('x') ]
-		# python-pillow
-		image = Image.open(filePath);
-		width, height = image.size
+		# python-pillow reads just the header
+		with Image.open(filePath) as image:
+			width, height = image.size
 	elif type == 'Video':
-		stdout = subprocess.Popen([ ToolFFprobe, filePath, '-show_streams' ], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL).communicate()[0].decode('utf-8')
-		width = int(re.search(r'^width=([0-9]+)$', stdout, re.MULTILINE).groups()[0])
-		height = int(re.search(r'^height=([0-9]+)$', stdout, re.MULTILINE).groups()[0])
+		streams = probeStreams(filePath)
+		width = streams['width'] or 0
+		height = streams['height'] or 0
 	else: # Audio or unknown
 		logE('Cannot get dimension for "{0}"'.format(os.path.join(os.getcwd(), filePath)))
 	return Size(width, height)
 AudioThumbnailWidth, AudioThumbnailHeight = mediaSize(AudioThumbnail)
 AudioPosterWidth, AudioPosterHeight = mediaSize(AudioPoster)
 
+#*** Probe cache
+# Probing every original (Pillow open or ffprobe fork) on every run is slow,
+# especially on network mounted site data. Probed values are stored in site
+# metadata folder and re-used as long as file size, mtime and inode match.
+ProbeCacheVersion = 2
+
+# Key: original file name with path relative to root folder
+# Value: dictionary with keys 'size', 'mtime', 'inode', 'type' and optionally
+#        'width', 'height' (see cachedMediaSize()), 'streams' (see
+#        cachedMediaStreams()), 'fingerprint' (see cachedFingerprint()) and
+#        'digest' (see cachedContentDigest())
+probeCache = {}
+# Keys of probe cache records used (verified or created) during this run
+probeCacheUsed = set()
+probeCacheChanged = False
+
+def loadProbeCache():
+	global probeCache
+	filePath = os.path.join(SiteMetaData, ProbeCacheFile)
+	try:
+		with open(filePath, 'r') as f:
+			data = json.load(f)
+		if data.get('version') == ProbeCacheVersion:
+			probeCache = data['files']
+		else:
+			logW('Ignored probe cache "{0}" with different version'.format(filePath))
+	except FileNotFoundError:
+		pass
+	except Exception as ex:
+		logW('Ignored unreadable probe cache "{0}" ({1})'.format(filePath, str(ex)))
+	logD('Loaded {0} probe cache records'.format(len(probeCache)))
+
+def storeProbeCache():
+	global probeCache, probeCacheChanged
+	# Forget files that were not seen during this run (removed or renamed)
+	removedCount = len([ key for key in probeCache.keys() if key not in probeCacheUsed ])
+	if not probeCacheChanged and removedCount == 0:
+		return
+	if argDryRun:
+		return
+	data = {}
+	data['version'] = ProbeCacheVersion
+	data['files'] = { key: probeCache[key] for key in probeCacheUsed if key in probeCache }
+	filePath = os.path.join(SiteMetaData, ProbeCacheFile)
+	try:
+		os.makedirs(SiteMetaData, mode = 0o755, exist_ok = True)
+		writeFileAtomically(filePath, json.dumps(data, separators = (',', ':'), sort_keys = True))
+		probeCache = data['files']
+		probeCacheChanged = False
+		logD('Stored {0} probe cache records'.format(len(data['files'])))
+	except Exception as ex:
+		logW('Cannot write probe cache "{0}" ({1})'.format(filePath, str(ex)))
+
+def probeCacheRecord(filePath):
+	# Returns probe cache record of the file, records of changed files are replaced by new ones
+	global probeCacheChanged
+	stat = os.stat(filePath)
+	probeCacheUsed.add(filePath)
+	record = probeCache.get(filePath)
+	if record is None \
+			or record['size'] != stat.st_size \
+			or record['mtime'] != stat.st_mtime_ns \
+			or record['inode'] != stat.st_ino:
+		record = {}
+		record['size'] = stat.st_size
+		record['mtime'] = stat.st_mtime_ns
+		record['inode'] = stat.st_ino
+		record['type'] = mediaType(os.path.splitext(filePath)[1])
+		probeCache[filePath] = record
+		probeCacheChanged = True
+	return record
+
+def cachedMediaStreams(filePath):
+	# Returns probed streams of video or audio file, see probeStreams()
+	global probeCacheChanged
+	record = probeCacheRecord(filePath)
+	if 'streams' not in record:
+		wallStart = time.monotonic()
+		record['streams'] = probeStreams(filePath)
+		runReport.addProbe(True, time.monotonic() - wallStart)
+		probeCacheChanged = True
+	else:
+		runReport.addProbe(False)
+	return record['streams']
+
+def cachedMediaSize(filePath):
+	global probeCacheChanged
+	record = probeCacheRecord(filePath)
+	if record['type'] == 'Video':
+		# Dimensions come from the same ffprobe run as codecs and bitrates
+		streams = cachedMediaStreams(filePath)
+		return Size(streams['width'] or 0, streams['height'] or 0)
+	if 'width' not in record:
+		wallStart = time.monotonic()
+		size = mediaSize(filePath)
+		runReport.addProbe(True, time.monotonic() - wallStart)
+		record['width'] = size.width
+		record['height'] = size.height
+		probeCacheChanged = True
+	else:
+		runReport.addProbe(False)
+	return Size(record['width'], record['height'])
+
+#*** Content fingerprint
+# Reading whole originals over network mount just to detect changes is too
+# expensive, so fingerprint is computed from file size and few samples of file
+# content (head, middle and tail) and cached together with size, mtime and
+# inode of the file (see probeCacheRecord()). Change keeping all of them is not
+# detected, nor in-place edit outside the samples. File modified shortly
+# before it was fingerprinted is ambiguous (later edit may keep the same coarse
+# mtime), its whole content is hashed on every run until its mtime is older.
+FingerprintSampleSize = 64 * 1024
+FingerprintMtimeGranularity = 2 * 1000 * 1000 * 1000 # Nanoseconds, FAT has the coarsest one
+
+hashedFingerprints = set() # Files with ambiguous fingerprint hashed by this run
+
+def fileFingerprint(filePath):
+	digest = hashlib.sha256()
+	with open(filePath, 'rb') as f:
+		fileSize = os.fstat(f.fileno()).st_size
+		digest.update(str(fileSize).encode('ascii'))
+		for offset in sorted(set([ 0, max(0, fileSize // 2 - FingerprintSampleSize // 2), max(0, fileSize - FingerprintSampleSize) ])):
+			f.seek(offset)
+			digest.update(f.read(FingerprintSampleSize))
+	return digest.hexdigest()
+
+def cachedFingerprint(filePath):
+	global probeCacheChanged
+	record = probeCacheRecord(filePath)
+	# Records without time of fingerprinting come from older runs and are trusted
+	if 'fingerprint' in record and (filePath in hashedFingerprints or record['mtime'] + FingerprintMtimeGranularity < record.get('fingerprinted', sys.maxsize)):
+		return record['fingerprint']
+	fingerprintTime = time.time_ns()
+	if 'fingerprint' not in record and record['mtime'] + FingerprintMtimeGranularity < fingerprintTime:
+		record['fingerprint'] = fileFingerprint(filePath)
+	else:
+		# Ambiguous fingerprint is computed the same way again, so that it
+		# stays the same for unchanged content
+		record['digest'] = fileContentDigest(filePath)
+		record['fingerprint'] = record['digest']
+		hashedFingerprints.add(filePath)
+	record['fingerprinted'] = fingerprintTime
+	probeCacheChanged = True
+	return record['fingerprint']
+
+def fileContentDigest(filePath):
+	digest = hashlib.sha256()
+	with open(filePath, 'rb') as f:
+		for block in iter(lambda: f.read(1024 * 1024), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+def cachedContentDigest(filePath):
+	# Digest of whole content, read only for originals with equal fingerprints
+	# to verify they are identical (see identicalOriginals())
+	global probeCacheChanged
+	record = probeCacheRecord(filePath)
+	if 'digest' not in record:
+		record['digest'] = fileContentDigest(filePath)
+		probeCacheChanged = True
+	return record['digest']
+
 def mediaShrunkenSize(originalSize, maxWidth, maxHeight):
 	width = 0
 	height = 0
@@ -300,42 +733,98 @@ def convertOriginalToMediaItem(galleryId, galleryName, fileName):
 	type = mediaType(fileExt)
 	if type != '':
 		mediaItem['type'] = type
-		id = mediaId(fileBase)
+		id, tags, title = parseMediaName(fileBase)
 		mediaItem['id'] = id
-		mediaItem['title'] = mediaTitle(fileBase)
-		mediaItem['tags'] = mediaTags(fileBase)
+		mediaItem['title'] = title
+		mediaItem['tags'] = tags
 		original = os.path.join(SiteData, Galleries, galleryName, fileName)
 		mediaItem['original'] = original
 		base = os.path.join(SiteMetaData, Galleries, galleryId, id)
 		if type == 'Image':
-			originalSize = mediaSize(original)
+			originalSize = cachedMediaSize(original)
 			thumbnailSize = mediaShrunkenSize(originalSize, MaxThumbnailWidth, MaxThumbnailHeight)
 			mediaItem['thumbnail']['path'] = base + MediaThumbnailSuffix + '.jpg'
 			mediaItem['thumbnail'].setSize(thumbnailSize)
 			posterSize = mediaShrunkenSize(originalSize, MaxImagePosterWidth, MaxImagePosterHeight)
 			mediaItem['poster']['path'] = base + MediaPosterSuffix + '.jpg'
 			mediaItem['poster'].setSize(posterSize)
+			mediaItem['posters'] = [ mediaItem['poster'] ]
+			for maxWidth, maxHeight in ImagePosterLadder:
+				posterSize = mediaShrunkenSize(originalSize, maxWidth, maxHeight)
+				if posterSize.width >= originalSize.width or posterSize in [ poster.size() for poster in mediaItem['posters'] ]:
+					continue
+				poster = ImageSrc()
+				poster['path'] = base + MediaPosterSuffix + '-{0}.jpg'.format(maxWidth)
+				poster.setSize(posterSize)
+				mediaItem['posters'].append(poster)
+			mediaItem['posters'].sort(key = lambda poster: poster['width'])
 		elif type == 'Video':
-			originalSize = mediaSize(original)
+			originalSize = cachedMediaSize(original)
 			thumbnailSize = mediaShrunkenSize(originalSize, MaxThumbnailWidth, MaxThumbnailHeight)
 			mediaItem['thumbnail']['path'] = base + MediaThumbnailSuffix + '.jpg'
 			mediaItem['thumbnail'].setSize(thumbnailSize)
 			posterSize = mediaShrunkenSize(originalSize, MaxVideoWidth, MaxVideoHeight)
 			mediaItem['poster']['path'] = base + MediaPosterSuffix + '.jpg'
 			mediaItem['poster'].setSize(posterSize)
+			mediaItem['posters'] = [ mediaItem['poster'] ]
 		elif type == 'Audio':
+			cachedMediaStreams(original) # Probed for stream-copy passthrough
 			thumbnailSize = Size(AudioThumbnailWidth, AudioThumbnailHeight)
 			mediaItem['thumbnail']['path'] = AudioThumbnail
 			mediaItem['thumbnail'].setSize(thumbnailSize)
 			posterSize = Size(AudioPosterWidth, AudioPosterHeight)
 			mediaItem['poster']['path'] = AudioPoster
 			mediaItem['poster'].setSize(posterSize)
+			mediaItem['posters'] = [ mediaItem['poster'] ]
 		else:
 			logE('Unknown type "{0}" for file {1}'.format(type, fileName))
 		mediaItem['galleryId'] = galleryId
 		mediaItem['galleryTitle'] = mediaTitle(galleryName)
 	return mediaItem
 
+def scanGallery(galleryId, galleryName):
+	# Returns array of (file name, MediaItem) tuples sorted by file name
+	galleryPath = os.path.join(SiteData, Galleries, galleryName)
+	with os.scandir(galleryPath) as entries:
+		fileNames = sorted([ entry.name for entry in entries if entry.is_file() ])
+	return [ (fileName, convertOriginalToMediaItem(galleryId, galleryName, fileName)) for fileName in fileNames ]
+
+def scanGalleriesIn():
+	# Returns (galleriesIn, galleryNames) tuple, see main
+	# Galleries are scanned in parallel threads, most of the time is spent
+	# waiting for (network) file system and external probing tools.
+	galleriesIn = {}
+	galleryNames = {}
+	with os.scandir(os.path.join(SiteData, Galleries)) as entries:
+		galleriesIn_Names = sorted([ entry.name for entry in entries if entry.is_dir() ])
+	with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+		scans = [ executor.submit(scanGallery, mediaId(galleryName), galleryName) for galleryName in galleriesIn_Names ]
+		for galleryName, scan in zip(galleriesIn_Names, scans):
+			addScannedGallery(galleriesIn, galleryNames, galleryName, scan.result())
+	return galleriesIn, galleryNames
+
+def addScannedGallery(galleriesIn, galleryNames, galleryName, scannedItems):
+	# scannedItems: array of (file name, MediaItem) tuples, see scanGallery()
+	logD('In Gallery: ' + galleryName)
+	galleryId = mediaId(galleryName)
+	if galleryId in galleriesIn.keys() and galleryNames[galleryId] != galleryName:
+		logE('          : Gallery ID {0} already exists!'.format(galleryId))
+		logW('          : Gallery "{0}" will be unabailable in favor of "{1}"'.format(galleryNames[galleryId], galleryName))
+	galleryNames[galleryId] = galleryName
+	galleriesIn[galleryId] = {}
+	readyItems.pop(galleryId, None)
+	for fileName, mediaItem in scannedItems:
+		logD('In    Item: ' + fileName)
+		if mediaItem['type'] == '':
+			logE('          : Ignored unsupported media type "{0}"'.format(fileName))
+		else:
+			itemId = mediaItem['id']
+			if itemId in galleriesIn[galleryId].keys():
+				logE('          : Gallery ID {0} already has item with ID {1}!'.format(galleryId, itemId))
+				logW('          : File "{0}" will be unabailable in favor of "{1}"'.format(galleriesIn[galleryId][itemId]['original'], mediaItem['original']))
+			else:
+				galleriesIn[galleryId][itemId] = mediaItem
+
 #def encodeUri(text):
 #	# TODO: Do better to not encode e.g. http:// to http%3A//
 #	return urllib.parse.quote(text)
@@ -343,22 +832,99 @@ def convertOriginalToMediaItem(galleryId, galleryName, fileName):
 def encodeHtml(text):
 	return html.escape(text)
 
-def storeToFile(filePath, data):
+#*** Atomic outputs
+# Every output is written to a temporary (hidden) file first and renamed to its
+# final name when complete. Interrupted run never leaves a partially written
+# file under the final name.
+
+def temporaryFileName(fileName):
+	# Temporary file keeps extension of the final one (ffmpeg and Pillow detect format by it)
+	folderName, name = os.path.split(fileName)
+	return os.path.join(folderName, '.tmp.' + name)
+
+def removeFile(fileName):
+	# Folders (e.g. video streams) are removed with their content
+	if stageRoot is not None and fileName.startswith(SiteMetaData + os.sep) and not os.path.basename(fileName).startswith('.tmp.'):
+		stageRemoved.add(fileName)
 	try:
-		fileOpen = False
-		if not argDryRun:
-			f = open(filePath, 'w')
-			fileOpen = True
+		if os.path.isdir(fileName) and not os.path.islink(fileName):
+			shutil.rmtree(fileName)
+		else:
+			os.remove(fileName)
+	except FileNotFoundError:
+		pass
+
+def pathSize(path):
+	# Returns size of file or total size of files in folder
+	if not os.path.isdir(path):
+		return os.path.getsize(path)
+	size = 0
+	for folderName, subfolderNames, fileNames in os.walk(path):
+		size += sum([ os.path.getsize(os.path.join(folderName, fileName)) for fileName in fileNames ])
+	return size
+
+def writeFileAtomically(filePath, data):
+	# data: string (stored in UTF-8) or bytes
+	temporaryName = temporaryFileName(filePath)
+	try:
+		if isinstance(data, bytes):
+			f = open(temporaryName, 'wb')
+		else:
+			f = open(temporaryName, 'w', encoding = 'utf-8')
+		with f:
 			f.write(data)
+		os.replace(temporaryName, filePath)
+	except:
+		removeFile(temporaryName)
+		raise
+
+CompressedExtensions = [ '.gz', '.br' ]
+
+def compressedSiblings(filePath):
+	# Returns dictionary
+	#     Key: file name of compressed copy of document (served by Apache
+	#          instead of the document, see .htaccess)
+	#     Value: compress function
+	siblings = {}
+	siblings[filePath + '.gz'] = lambda data: gzip.compress(data, compresslevel = 9, mtime = 0)
+	if brotli is not None:
+		siblings[filePath + '.br'] = lambda data: brotli.compress(data, mode = brotli.MODE_TEXT, quality = 11)
+	return siblings
+
+def storeToFile(filePath, data, digestData = None):
+	# digestData: part of data identifying its content (e.g. without generation
+	#     date), whole data is used by default
+	# File is not rewritten when its content did not change since last write,
+	# so its modification time (and HTTP caching) is kept. Compressed siblings
+	# are written together with the file, they are part of the digest.
+	global manifestChanged
+	siblings = compressedSiblings(filePath)
+	digestData = (data if digestData is None else digestData) + '\n'.join(sorted(siblings.keys()))
+	digest = hashlib.sha1(digestData.encode('utf-8')).hexdigest()
+	if documentDigests.get(filePath) == digest and os.path.isfile(stagedOrPublishedPath(filePath)):
+		logD('Unchanged "{0}"'.format(filePath))
+		return
+	try:
+		if not argDryRun:
+			encodedData = data.encode('utf-8')
+			for siblingPath, compress in siblings.items():
+				compressedData = compress(encodedData)
+				writeFileAtomically(siblingPath, compressedData)
+				runReport.addBytes(bytesOut = len(compressedData))
+			for extension in CompressedExtensions:
+				# Outdated sibling would be served otherwise (e.g. brotli uninstalled)
+				if filePath + extension not in siblings:
+					removeFile(filePath + extension)
+			writeFileAtomically(filePath, encodedData)
+			runReport.addBytes(bytesOut = len(encodedData))
+			documentDigests[filePath] = digest
+			manifestChanged = True
 		else:
 			print(data)
 		logI('Generated "{0}"'.format(filePath))
 	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(filePath), str(ex))
+		logE('Cannot write to "{0}" ({1})'.format(filePath, str(ex)))
 		logI('  Current folder is: "{0}"'.format(os.getcwd()))
-	finally:
-		if fileOpen:
-			f.close()
 
 def generateRss(galleriesIn, galleriesOut, galleryNames):
 	def rssItem(title, link, guid, date, description):
@@ -472,7 +1038,38 @@ def generateRss(galleriesIn, galleriesOut, galleryNames):
 </rss>
 '''
 		rssFilePath = os.path.join(SiteMetaData, 'rss.xml')
-		storeToFile(rssFilePath, rssFileData)
+		storeToFile(rssFilePath, rssFileData, rssFileData.replace(itemDate, ''))
+
+def publishedImageSrc(imageSrc):
+	# Returns copy of image source with its alternative formats that exist
+	publishedSrc = ImageSrc()
+	dict.update(publishedSrc, imageSrc)
+	publishedSrc['alternatives'] = []
+	for fileExt in ImageAlternativeFormats:
+		filePath = alternativeImagePath(imageSrc['path'], fileExt)
+		if filePath in manifest:
+			alternative = {}
+			alternative['path'] = filePath
+			alternative['type'] = ImageFormats[fileExt][1]
+			alternative['bytes'] = manifest[filePath]['bytes']
+			publishedSrc['alternatives'].append(alternative)
+	return publishedSrc
+
+def publishedMediaItem(mediaItem, sprite = None):
+	# Returns media item as published in JSON documents
+	# sprite: thumbnail position in sprite sheet, see itemSprites()
+	publishedItem = MediaItem()
+	dict.update(publishedItem, mediaItem)
+	if mediaItem['type'] == 'Image' and len(ImageAlternativeFormats) > 0:
+		publishedItem['thumbnail'] = publishedImageSrc(mediaItem['thumbnail'])
+		publishedItem['poster'] = publishedImageSrc(mediaItem['poster'])
+		publishedItem['posters'] = [ publishedImageSrc(poster) for poster in mediaItem['posters'] ]
+	publishedItem['sprite'] = sprite
+	if mediaItem['type'] in [ 'Image', 'Video' ]:
+		publishedItem['placeholder'] = manifest.get(mediaItem['thumbnail']['path'], {}).get('placeholder', '')
+	if mediaItem['type'] == 'Video' and videoStreamFolder(mediaItem) in manifest:
+		publishedItem['stream'] = os.path.join(videoStreamFolder(mediaItem), VideoStreamPlaylist)
+	return publishedItem
 
 def generateJson_News(galleriesIn, galleriesOut, galleryNames):
 	newGalleries = []
@@ -485,7 +1082,7 @@ def generateJson_News(galleriesIn, galleriesOut, galleryNames):
 		for itemId in itemIds:
 			# Show at least 10 items and use "... and X more" for X >= 5
 			if itemsCount < 10 or itemsCount + 5 > totalItemsCount:
-				showItems.append(galleriesIn[galleryId][itemId])
+				showItems.append(publishedMediaItem(galleriesIn[galleryId][itemId]))
 			else:
 				notListedItemsCount = totalItemsCount - itemsCount
 				break
@@ -511,7 +1108,7 @@ def generateJson_News(galleriesIn, galleriesOut, galleryNames):
 		for itemId in newItemIds:
 			# Show at least 10 items and use "... and X more" for X >= 5
 			if itemsCount < 10 or itemsCount + 5 > totalNewItemsCount:
-				showItems.append(galleriesIn[galleryId][itemId])
+				showItems.append(publishedMediaItem(galleriesIn[galleryId][itemId]))
 			else:
 				notListedItemsCount = totalNewItemsCount - itemsCount
 				break
@@ -533,31 +1130,146 @@ def generateJson_News(galleriesIn, galleriesOut, galleryNames):
 		newsRecord['modifiedGalleries'] = modifiedGalleries
 		newsRecords = [ newsRecord ] # Array with one item only
 		newsFileData = json.dumps(newsRecords, separators = (',', ':'), sort_keys = True, ensure_ascii = False, indent = 1)
-		storeToFile(newsFilePath, newsFileData)
-
-def generateJson_Galleries(galleriesIn, galleriesOut, galleryNames):
+		newsDigestData = json.dumps([ newGalleries, modifiedGalleries ], sort_keys = True) # Without date
+		storeToFile(newsFilePath, newsFileData, newsDigestData)
+
+def isMediaItemReady(mediaItem):
+	# Media item is ready to be shown when its thumbnail is up to date
+	fileNames = staleDerivatives(mediaItem)
+	return 'thumbnail' not in fileNames
+
+# Readiness is checked once per gallery (staleDerivatives() stats originals)
+# and updated as thumbnails are created. Galleries are published many times
+# during media generation (see onGalleryThumbnailsDone), checking all items
+# of all galleries every time would block job scheduling.
+# Key: gallery ID
+# Value: set of IDs of items with up to date thumbnails
+readyItems = {}
+
+def galleryReadyItemIds(galleryId, galleryItems):
+	# galleryItems: dictionary of media items of the gallery (key: item ID)
+	if galleryId not in readyItems:
+		readyItems[galleryId] = set([ itemId for itemId, mediaItem in galleryItems.items() if isMediaItemReady(mediaItem) ])
+	return readyItems[galleryId]
+
+def markMediaItemReady(mediaItem):
+	# Called when thumbnail of the item is created
+	if mediaItem['galleryId'] in readyItems:
+		readyItems[mediaItem['galleryId']].add(mediaItem['id'])
+
+def readyItemIds(galleriesIn, galleryId, readyOnly):
+	itemIds = sorted(galleriesIn[galleryId].keys())
+	if readyOnly:
+		readyIds = galleryReadyItemIds(galleryId, galleriesIn[galleryId])
+		itemIds = [ itemId for itemId in itemIds if itemId in readyIds ]
+	return itemIds
+
+def generateJson_GalleriesList(galleriesIn, galleryNames, readyOnly = False):
+	# readyOnly: list only items with existing thumbnails, galleries without
+	#     such items are omitted
 	galleriesRecords = []
 	for galleryId in sorted(galleriesIn.keys()):
-		lastItemId = sorted(galleriesIn[galleryId].keys())[-1]
+		itemIds = readyItemIds(galleriesIn, galleryId, readyOnly)
+		if len(itemIds) == 0:
+			continue
+		lastItemId = itemIds[-1]
 		galleriesRecord = {}
 		galleriesRecord['id'] = galleryId
 		galleriesRecord['title'] = mediaTitle(galleryNames[galleryId])
-		galleriesRecord['lastItem'] = galleriesIn[galleryId][lastItemId]
+		galleriesRecord['lastItem'] = publishedMediaItem(galleriesIn[galleryId][lastItemId])
 		galleriesRecords.append(galleriesRecord)
 	galleriesFileData = json.dumps(galleriesRecords, separators = (',', ':'), sort_keys = True, ensure_ascii = False, indent = 1)
 	galleriesFilePath = os.path.join(SiteMetaData, 'galleries.json')
 	storeToFile(galleriesFilePath, galleriesFileData)
 
-	for galleryId in sorted(galleriesIn.keys()):
-		galleryRecords = [ galleriesIn[galleryId][itemId] for itemId in sorted(galleriesIn[galleryId].keys()) ]
+def galleryPageFilePath(galleryId, pageNum):
+	return os.path.join(SiteMetaData, Galleries, '{0}.page-{1}.json'.format(galleryId, pageNum))
+
+def removeDocument(filePath, untracked = False):
+	# Removes generated document known from its digest
+	# untracked: existing document without digest (e.g. written before
+	#     manifest existed) is removed too
+	global manifestChanged
+	if filePath not in documentDigests and not (untracked and os.path.lexists(stagedOrPublishedPath(filePath))):
+		return
+	if not argDryRun:
+		removeFile(filePath)
+		for extension in CompressedExtensions:
+			removeFile(filePath + extension)
+		documentDigests.pop(filePath, None)
+		manifestChanged = True
+	logI('Removed "{0}"'.format(filePath))
+
+def removeGalleryPages(galleryId, keepPagesCount):
+	# Removes pages (and index when no page is kept) not used anymore
+	if keepPagesCount == 0:
+		removeDocument(os.path.join(SiteMetaData, Galleries, galleryId + '.index.json'))
+	pageNum = keepPagesCount + 1
+	while galleryPageFilePath(galleryId, pageNum) in documentDigests:
+		removeDocument(galleryPageFilePath(galleryId, pageNum))
+		pageNum += 1
+
+def generateJson_GalleryPages(galleryId, galleryRecords):
+	# Index contains everything needed before items are loaded (counts of
+	# items, tags and types for gallery filter) and list of pages
+	pages = []
+	tags = {}
+	types = {}
+	for first in range(0, len(galleryRecords), GalleryPageSize):
+		pageRecords = galleryRecords[first:first + GalleryPageSize]
+		pageFilePath = galleryPageFilePath(galleryId, len(pages) + 1)
+		pageFileData = json.dumps(pageRecords, separators = (',', ':'), sort_keys = True, ensure_ascii = False)
+		storeToFile(pageFilePath, pageFileData)
+		page = {}
+		page['path'] = pageFilePath
+		page['count'] = len(pageRecords)
+		page['firstId'] = pageRecords[0]['id']
+		page['lastId'] = pageRecords[-1]['id']
+		pages.append(page)
+		for record in pageRecords:
+			for tag in record['tags']:
+				tags[tag] = tags.get(tag, 0) + 1
+			types[record['type']] = types.get(record['type'], 0) + 1
+	indexRecord = {}
+	indexRecord['id'] = galleryId
+	indexRecord['title'] = galleryRecords[0]['galleryTitle']
+	indexRecord['count'] = len(galleryRecords)
+	indexRecord['tags'] = tags
+	indexRecord['types'] = types
+	indexRecord['pages'] = pages
+	indexFileData = json.dumps(indexRecord, separators = (',', ':'), sort_keys = True, ensure_ascii = False)
+	indexFilePath = os.path.join(SiteMetaData, Galleries, galleryId + '.index.json')
+	storeToFile(indexFilePath, indexFileData)
+	removeGalleryPages(galleryId, len(pages))
+
+def generateJson_Gallery(galleriesIn, galleryNames, galleryId, readyOnly = False):
+	itemIds = readyItemIds(galleriesIn, galleryId, readyOnly)
+	if len(itemIds) == 0:
+		return
+	sprites = itemSprites(galleryId, galleriesIn[galleryId])
+	galleryRecords = [ publishedMediaItem(galleriesIn[galleryId][itemId], sprites.get(itemId)) for itemId in itemIds ]
+	galleryFilePath = os.path.join(SiteMetaData, Galleries, galleryId + '.json')
+	if not argDryRun:
+		os.makedirs(os.path.dirname(galleryFilePath), mode = 0o755, exist_ok = True)
+	if GalleryPageSize > 0 and len(galleryRecords) > GalleryPageSize:
+		generateJson_GalleryPages(galleryId, galleryRecords)
+		# Browser would load whole gallery left by older version instead
+		removeDocument(galleryFilePath, True)
+	else:
 		galleryFileData = json.dumps(galleryRecords, separators = (',', ':'), sort_keys = True, ensure_ascii = False, indent = 1)
-		galleryFilePath = os.path.join(SiteMetaData, Galleries, galleryId + '.json')
 		storeToFile(galleryFilePath, galleryFileData)
+		removeGalleryPages(galleryId, 0)
+
+def generateJson_Galleries(galleriesIn, galleriesOut, galleryNames, readyOnly = False, galleryIds = None):
+	# galleryIds: IDs of galleries to generate pages for, all when None
+	generateJson_GalleriesList(galleriesIn, galleryNames, readyOnly)
+	for galleryId in sorted(galleriesIn.keys() if galleryIds is None else galleryIds):
+		generateJson_Gallery(galleriesIn, galleryNames, galleryId, readyOnly)
 
-def generateJson(galleriesIn, galleriesOut, galleryNames):
+def generateJson(galleriesIn, galleriesOut, galleryNames, readyOnly = False, galleryIds = None):
 	logI('')
 	generateJson_News(galleriesIn, galleriesOut, galleryNames)
-	generateJson_Galleries(galleriesIn, galleriesOut, galleryNames)
+	generateJson_Galleries(galleriesIn, galleriesOut, galleryNames, readyOnly, galleryIds)
 	#generateJson_Projects(galleriesIn, galleriesOut, galleryNames)
 	#generateJson_Japanese(galleriesIn, galleriesOut, galleryNames)
 
@@ -571,175 +1283,1466 @@ def videoScaleArg(size):
 		scale = 'scale=trunc(oh*a/2)*2:{0}'.format(size.height)
 	return scale
 
-def createImageThumbnail(mediaItem, fileName):
+def alternativeImagePath(filePath, fileExt):
+	return os.path.splitext(filePath)[0] + '.' + fileExt
+
+def imageDerivatives(mediaItem):
+	# Returns dictionary
+	#     Key: derivative kind ('thumbnail', 'poster' or 'poster-<width>' for
+	#          JPEG files, the same with '.<extension>' for alternative formats)
+	#     Value: (ImageSrc, file extension) tuple
+	sources = {}
+	sources['thumbnail'] = mediaItem['thumbnail']
+	for poster in mediaItem['posters']:
+		if poster['path'] == mediaItem['poster']['path']:
+			sources['poster'] = poster
+		else:
+			sources['poster-{0}'.format(poster['width'])] = poster
+	derivatives = {}
+	for kind, source in sources.items():
+		derivatives[kind] = (source, 'jpg')
+		for fileExt in ImageAlternativeFormats:
+			derivatives[kind + '.' + fileExt] = (source, fileExt)
+	return derivatives
+
+def imageEncoderSettings(kind, source, fileExt):
+	# Returns dictionary with keys 'format' (Pillow format), 'options' (save
+	# options), 'maxBytes' (byte budget or None) and 'stripMetadata'
+	settings = {}
+	settings['format'] = ImageFormats[fileExt][0]
+	if fileExt != 'jpg':
+		settings['options'] = ImageFormats[fileExt][2]
+		settings['maxBytes'] = None
+		settings['stripMetadata'] = True
+		return settings
+	profile = ImageEncoderProfiles['thumbnail' if kind == 'thumbnail' else 'poster']
+	settings['options'] = { key: profile[key] for key in [ 'quality', 'progressive', 'optimize', 'subsampling' ] }
+	settings['maxBytes'] = profile['maxBytes']
+	if settings['maxBytes'] is not None and kind.startswith('poster-'):
+		area = source['width'] * source['height']
+		settings['maxBytes'] = round(settings['maxBytes'] * area / (MaxImagePosterWidth * MaxImagePosterHeight))
+	settings['stripMetadata'] = profile['stripMetadata']
+	return settings
+
+def encodeImage(image, settings, metadata):
+	# Returns (encoded data, quality) tuple, quality is None for formats without byte budget
+	# metadata: save options with metadata of original ('exif', 'icc_profile')
+	options = dict(settings['options'])
+	for key, value in metadata.items():
+		# Color profile is kept even when other metadata are stripped
+		if key == 'icc_profile' or not settings['stripMetadata']:
+			options[key] = value
+	def encode(quality):
+		data = io.BytesIO()
+		if quality is not None:
+			options['quality'] = quality
+		image.save(data, settings['format'], **options)
+		return data.getvalue()
+	if settings['maxBytes'] is None:
+		return (encode(None), None)
+	# Bisect the highest quality fitting byte budget (file size mostly
+	# decreases with quality), the smallest result is used when nothing fits
+	quality = settings['options']['quality']
+	smallest = (encode(quality), quality)
+	if len(smallest[0]) <= settings['maxBytes']:
+		return smallest
+	fitting = None
+	low = MinImageQuality
+	high = quality - 1
+	while low <= high:
+		quality = (low + high) // 2
+		data = encode(quality)
+		if len(data) <= settings['maxBytes']:
+			if fitting is None or quality > fitting[1]:
+				fitting = (data, quality)
+			low = quality + 1
+		else:
+			if len(data) < len(smallest[0]):
+				smallest = (data, quality)
+			high = quality - 1
+	return smallest if fitting is None else fitting
+
+def placeholderDataUri(image):
+	# Returns data URI of tiny JPEG made from given image (not modified)
+	placeholder = image.copy()
+	placeholder.thumbnail((PlaceholderSize, PlaceholderSize), Image.Resampling.LANCZOS)
+	data = io.BytesIO()
+	placeholder.save(data, 'JPEG', quality = PlaceholderQuality, optimize = True)
+	return 'data:image/jpeg;base64,' + base64.b64encode(data.getvalue()).decode('ascii')
+
+def createImageDerivatives(mediaItem, fileNames, details):
+	# fileNames: dictionary
+	#     Key: derivative kind, see imageDerivatives()
+	#     Value: output file name
+	# details: dictionary filled with details recorded in manifest for created
+	#     files (key: file name, value: dictionary with 'settings' chosen for
+	#     byte budget, 'placeholder' made from thumbnail)
+	# Original is decoded only once, the biggest poster is created first and
+	# every smaller derivative is downscaled from the previous one then. All
+	# formats of one size are stored from the same downscaled image.
+	derivatives = imageDerivatives(mediaItem)
+	kinds = sorted(fileNames.keys(), key = lambda kind: derivatives[kind][0]['width'], reverse = True)
 	try:
+		image = None
+		metadata = {}
 		if not argDryRun:
 			image = Image.open(mediaItem['original'], 'r')
-			image.thumbnail(mediaItem['thumbnail'].size(), Image.Resampling.LANCZOS)
-			image.save(fileName, "JPEG")
-		logI('Created "{0}"'.format(fileName))
+			for key in [ 'exif', 'icc_profile' ]:
+				if key in image.info:
+					metadata[key] = image.info[key]
+			# Let JPEG decoder downscale by 1/2, 1/4 or 1/8 during decoding,
+			# decoded image is never smaller than requested size
+			image.draft('RGB', derivatives[kinds[0]][0].size())
+			if image.mode not in ('RGB', 'L'):
+				image = image.convert('RGB')
 	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createImagePoster(mediaItem, fileName):
+		for fileName in fileNames.values():
+			logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+		return []
+	createdFileNames = []
+	for kind in kinds:
+		fileName = fileNames[kind]
+		source, fileExt = derivatives[kind]
+		try:
+			if not argDryRun:
+				#image.resize(mediaItem['poster'].size(), Image.Resampling.LANCZOS) # File is too big
+				image.thumbnail(source.size(), Image.Resampling.LANCZOS)
+				data, quality = encodeImage(image, imageEncoderSettings(kind, source, fileExt), metadata)
+				writeFileAtomically(fileName, data)
+				if quality is not None:
+					details.setdefault(fileName, {})['settings'] = { 'quality': quality }
+				if kind == 'thumbnail':
+					details.setdefault(fileName, {})['placeholder'] = placeholderDataUri(image)
+			logI('Created "{0}"'.format(fileName))
+			createdFileNames.append(fileName)
+		except Exception as ex:
+			removeFile(temporaryFileName(fileName))
+			logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+	return createdFileNames
+
+def createImageDerivativesBatch(jobs):
+	# jobs: array of (mediaItem, fileNames) tuples, see createImageDerivatives()
+	# Returns array of (created file names, job statistics, details of created
+	# files) tuples, one for every job
+	results = []
+	for mediaItem, fileNames in jobs:
+		wallStart = time.monotonic()
+		cpuStart = time.process_time()
+		details = {}
+		createdFileNames = createImageDerivatives(mediaItem, fileNames, details)
+		jobStats = {}
+		jobStats['wallTime'] = time.monotonic() - wallStart
+		jobStats['cpuTime'] = time.process_time() - cpuStart
+		results.append((createdFileNames, jobStats, details))
+	return results
+#*** Job runner
+# Media jobs mostly wait for external tools, so they are orchestrated by asyncio
+# in the main process. External tools are launched directly and only image
+# jobs run in a small pool of Pillow processes. All jobs share one budget of
+# threads, so multi-threaded tools do not oversubscribe CPUs.
+#
+# Jobs are scheduled by their class, cheap thumbnails and posters go first so
+# galleries become usable soon, long transcodes go last. Concurrency of slow
+# classes is limited to always leave some threads for the urgent ones.
+
+# Key: job class
+# Value: dictionary with keys 'priority' (lower runs first) and 'limit' (max. running jobs)
+JobClasses = {
+	'thumbnail': { 'priority': 0, 'limit': CpuThreads },
+	'poster': { 'priority': 1, 'limit': CpuThreads },
+	'audio': { 'priority': 2, 'limit': max(1, CpuThreads // 2) },
+	'transcode': { 'priority': 3, 'limit': max(1, (CpuThreads + 1) // 2) },
+}
+
+def jobClass(mediaItem, fileNames):
+	if mediaItem['type'] == 'Audio':
+		return 'audio'
+	if any([ kind in VideoFormatArgs.keys() or kind == VideoStreamKind for kind in fileNames.keys() ]):
+		return 'transcode'
+	if 'thumbnail' in fileNames:
+		return 'thumbnail'
+	return 'poster'
+
+def batchJobClass(batch):
+	# Batch runs as its most urgent job, e.g. image batch with any thumbnail
+	# runs as thumbnail job
+	return min([ jobClass(mediaItem, fileNames) for mediaItem, fileNames in batch ], key = lambda name: JobClasses[name]['priority'])
+
+class JobScheduler:
+	def __init__(self, threads):
+		self.free = threads
+		self.running = { name: 0 for name in JobClasses.keys() }
+		self.waiting = [] # Heap of (priority, sequence, job class, max. threads, future)
+		self.sequence = 0 # Keeps FIFO order of jobs with the same priority
+	async def acquire(self, jobClass, maxThreads = None):
+		# Returns number of threads granted to the job (at least one). Free threads
+		# are shared among all waiting jobs, so the last jobs get more threads.
+		future = asyncio.get_running_loop().create_future()
+		heapq.heappush(self.waiting, (JobClasses[jobClass]['priority'], self.sequence, jobClass, maxThreads, future))
+		self.sequence += 1
+		# Dispatch later, so all jobs started at once are queued (and sorted) first
+		asyncio.get_running_loop().call_soon(self._dispatch)
+		return await future
+	def release(self, jobClass, threads):
+		self.free += threads
+		self.running[jobClass] -= 1
+		self._dispatch()
+	def _dispatch(self):
+		blocked = []
+		while self.free > 0 and len(self.waiting) > 0:
+			entry = heapq.heappop(self.waiting)
+			jobClass, maxThreads, future = entry[2:]
+			if self.running[jobClass] >= JobClasses[jobClass]['limit']:
+				blocked.append(entry)
+				continue
+			threads = max(1, self.free // (1 + len(self.waiting)))
+			if maxThreads is not None:
+				threads = min(threads, maxThreads)
+			self.free -= threads
+			self.running[jobClass] += 1
+			future.set_result(threads)
+		for entry in blocked:
+			heapq.heappush(self.waiting, entry)
+
+async def runTool(command, jobStats, captureOutput = False):
+	# jobStats: dictionary with keys 'wallTime' and 'cpuTime' incremented by the tool run
+	# Returns standard output (bytes) when captureOutput is True, None otherwise
+	logD('Running: ' + ' '.join(command))
+	wallStart = time.monotonic()
+	process = await asyncio.create_subprocess_exec(*command,
+		stdin = subprocess.DEVNULL, stdout = subprocess.PIPE if captureOutput else subprocess.DEVNULL, stderr = subprocess.PIPE)
+	stdout, stderr = await process.communicate()
+	stderr = stderr.decode('utf-8', 'replace')
+	jobStats['wallTime'] += time.monotonic() - wallStart
+	# CPU time of ffmpeg is printed out by its -benchmark option
+	for match in re.finditer(r'^bench: utime=([0-9.]+)s stime=([0-9.]+)s', stderr, re.MULTILINE):
+		jobStats['cpuTime'] += float(match.group(1)) + float(match.group(2))
+	if process.returncode != 0:
+		lines = [ line for line in stderr.splitlines() if line.strip() != '' ]
+		raise RuntimeError('"{0}" failed with exit code {1}: {2}'.format(command[0], process.returncode, lines[-1] if len(lines) > 0 else ''))
+	return stdout
+
+# Overwrite leftover temporary files, print out CPU time but not progress
+FFmpegCommonArgs = [ '-y', '-hide_banner', '-nostats', '-benchmark' ]
+
+# Key: audio derivative kind (output file extension)
+# Value: ffmpeg output arguments (without output file name)
+AudioFormatArgs = {
+	'mp3': [ '-vn',
+			'-codec:a', 'libmp3lame',
+			'-b:a', '160k', '-ar', '44100', '-ac', '2',
+			'-f', 'mp3' ],
+	'ogg': [ '-vn',
+			'-codec:a', 'libvorbis',
+			'-b:a', '160k', '-ar', '44100', '-ac', '2',
+			'-f', 'ogg' ],
+}
+# Originals already meeting constraints of a target format are remuxed (streams
+# copied) instead of transcoded, e.g. H.264/AAC videos from phones
+# Key: audio or video derivative kind
+# Value: dictionary with keys 'videoCodecs' and 'audioCodecs' (accepted codecs,
+#        None for missing stream), 'maxBitrate' (overall, videos only),
+#        'maxAudioBitrate' (audio files only) and 'args' (ffmpeg output
+#        arguments without stream maps and output file name)
+PassthroughFormats = {
+	'mp4': { 'videoCodecs': [ 'h264' ], 'audioCodecs': [ 'aac', None ], 'maxBitrate': 2500000,
+			'args': [ '-codec', 'copy', '-movflags', '+faststart', '-f', 'mp4' ] },
+	'ogv': { 'videoCodecs': [ 'theora' ], 'audioCodecs': [ 'vorbis', None ], 'maxBitrate': 2500000,
+			'args': [ '-codec', 'copy', '-f', 'ogg' ] },
+	'webm': { 'videoCodecs': [ 'vp8', 'vp9' ], 'audioCodecs': [ 'vorbis', 'opus', None ], 'maxBitrate': 2500000,
+			'args': [ '-codec', 'copy', '-f', 'webm' ] },
+	'mp3': { 'audioCodecs': [ 'mp3' ], 'maxAudioBitrate': 160000,
+			'args': [ '-codec:a', 'copy', '-f', 'mp3' ] },
+	'ogg': { 'audioCodecs': [ 'vorbis' ], 'maxAudioBitrate': 160000,
+			'args': [ '-codec:a', 'copy', '-f', 'ogg' ] },
+}
+
+def isPassthrough(mediaItem, kind):
+	# Returns True when derivative of given kind can be remuxed from original
+	if kind not in PassthroughFormats:
+		return False
+	constraints = PassthroughFormats[kind]
+	streams = cachedMediaStreams(mediaItem['original'])
+	if streams['audioCodec'] not in constraints['audioCodecs']:
+		return False
+	if streams['audioChannels'] is not None and streams['audioChannels'] > 2:
+		return False
+	if mediaItem['type'] == 'Video':
+		return streams['videoCodec'] in constraints['videoCodecs'] \
+				and Size(streams['width'], streams['height']) == mediaItem['poster'].size() \
+				and streams['bitrate'] is not None and streams['bitrate'] <= constraints['maxBitrate']
+	return streams['audioBitrate'] is not None and streams['audioBitrate'] <= constraints['maxAudioBitrate']
+
+def audioDerivativesCommand(mediaItem, fileNames, threads, original):
+	# original: file name of original to read (local copy when staging)
+	command = [ ToolFFmpeg ] + FFmpegCommonArgs + [ '-threads', str(threads), '-i', original ]
+	for kind in AudioFormatArgs.keys():
+		if kind not in fileNames:
+			continue
+		if isPassthrough(mediaItem, kind):
+			logD('Copying audio stream of "{0}" to "{1}"'.format(mediaItem['original'], fileNames[kind]))
+			command += [ '-map', '0:a:0' ] + PassthroughFormats[kind]['args'] + [ temporaryFileName(fileNames[kind]) ]
+		else:
+			command += AudioFormatArgs[kind] + [ '-threads', str(threads), temporaryFileName(fileNames[kind]) ]
+	return command
+async def runAudioDerivatives(mediaItem, fileNames, scheduler, jobStats, original):
+	# fileNames: dictionary
+	#     Key: derivative kind ('mp3' or 'ogg')
+	#     Value: output file name
+	# original: file name of original to read (local copy when staging)
+	# Returns array of successfully created file names
+	journalStart(fileNames.values())
+	threads = await scheduler.acquire('audio')
 	try:
-		if not argDryRun:
-			image = Image.open(mediaItem['original'], 'r')
-			#image.resize(mediaItem['poster'].size(), Image.Resampling.LANCZOS) # File is too big
-			image.thumbnail(mediaItem['poster'].size(), Image.Resampling.LANCZOS)
-			image.save(fileName, "JPEG")
-		logI('Created "{0}"'.format(fileName))
+		await runTool(audioDerivativesCommand(mediaItem, fileNames, threads, original), jobStats)
+		for fileName in fileNames.values():
+			os.replace(temporaryFileName(fileName), fileName)
 	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createAudioMp3(mediaItem, fileName):
-	try:
-		if not argDryRun:
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-vn',
-						'-codec:a', 'libmp3lame',
-						'-b:a', '160k', '-ar', '44100', '-ac', '2',
-						'-f', 'mp3', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
+		for fileName in fileNames.values():
+			removeFile(temporaryFileName(fileName))
+			logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+		return []
+	finally:
+		scheduler.release('audio', threads)
+	for fileName in fileNames.values():
 		logI('Created "{0}"'.format(fileName))
-	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createAudioOgg(mediaItem, fileName):
+	return list(fileNames.values())
+# Key: video derivative kind (output file extension)
+# Value: ffmpeg output arguments (without output file name)
+VideoFormatArgs = {
+	'mp4': [ '-codec:v', 'libx264',
+			'-b:v', '500k',
+			'-codec:a', 'aac',
+			'-b:a', '160k', '-ar', '44100', '-ac', '2',
+			'-f', 'mp4' ],
+	'ogv': [ '-codec:v', 'libtheora',
+			'-b:v', '500k',
+			'-codec:a', 'libvorbis',
+			'-b:a', '160k', '-ar', '44100', '-ac', '2',
+			'-f', 'ogg' ],
+	'webm': [ '-codec:v', 'libvpx',
+			'-b:v', '500k',
+			'-codec:a', 'libvorbis',
+			'-b:a', '160k', '-ar', '44100', '-ac', '2',
+			'-f', 'webm' ],
+}
+# Derivative kind of HLS stream (folder)
+VideoStreamKind = 'hls'
+
+def videoStreamFolder(mediaItem):
+	return os.path.join(SiteMetaData, Galleries, mediaItem['galleryId'], mediaItem['id'] + VideoStreamFolderSuffix)
+
+def videoStreamRenditions(mediaItem):
+	# Returns array of (Size, video bitrate) tuples sorted by width
+	originalSize = cachedMediaSize(mediaItem['original'])
+	renditions = []
+	for maxWidth, maxHeight, bitrate in VideoStreamLadder:
+		size = mediaShrunkenSize(originalSize, maxWidth, maxHeight)
+		if size not in [ renditionSize for renditionSize, renditionBitrate in renditions ]:
+			renditions.append((size, bitrate))
+	renditions.sort(key = lambda rendition: rendition[0].width)
+	return renditions
+
+def videoStreamName(size):
+	return '{0}x{1}'.format(size.width, size.height)
+
+def videoStreamArgs(size, bitrate):
+	# Returns ffmpeg output arguments of one rendition (without output file name)
+	return [ '-codec:v', 'libx264', '-profile:v', 'main',
+			'-b:v', str(bitrate), '-maxrate', str(bitrate * 107 // 100), '-bufsize', str(bitrate * 3 // 2),
+			'-force_key_frames', 'expr:gte(t,n_forced*{0})'.format(VideoStreamSegmentTime), '-sc_threshold', '0',
+			'-codec:a', 'aac',
+			'-b:a', str(VideoStreamAudioBitrate), '-ar', '44100', '-ac', '2',
+			'-f', 'hls', '-hls_time', str(VideoStreamSegmentTime), '-hls_playlist_type', 'vod',
+			'-hls_flags', 'independent_segments', '-hls_segment_type', 'mpegts' ]
+
+def videoStreamMasterPlaylist(renditions):
+	lines = [ '#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS' ]
+	for size, bitrate in renditions:
+		bandwidth = bitrate * 107 // 100 + VideoStreamAudioBitrate
+		lines.append('#EXT-X-STREAM-INF:BANDWIDTH={0},RESOLUTION={1}'.format(bandwidth, videoStreamName(size)))
+		lines.append(videoStreamName(size) + '.m3u8')
+	return '\n'.join(lines) + '\n'
+
+def videoDerivativesCommand(mediaItem, fileNames, threads, original):
+	# original: file name of original to read (local copy when staging)
+	# Original is decoded only once, the filter graph splits decoded stream into
+	# stream renditions, still frame and stream scaled to poster size for all
+	# encoders. Still frame (poster size) is written as raw RGB frame to
+	# standard output, thumbnail and poster are made from it by Pillow then,
+	# see createVideoStills().
+	copyKinds = [ kind for kind in VideoFormatArgs.keys() if kind in fileNames and isPassthrough(mediaItem, kind) ]
+	encodeKinds = [ kind for kind in VideoFormatArgs.keys() if kind in fileNames and kind not in copyKinds ]
+	stillKinds = [ kind for kind in [ 'thumbnail', 'poster' ] if kind in fileNames ]
+	renditions = videoStreamRenditions(mediaItem) if VideoStreamKind in fileNames else []
+	filters = []
+	labels = [ '[stream{0}]'.format(index) for index in range(len(renditions)) ]
+	if len(encodeKinds) > 0:
+		labels.append('[video]')
+	if len(stillKinds) > 0:
+		labels.append('[stillSource]')
+	if len(labels) > 0:
+		filters.append('[0:v]split={0}{1}'.format(len(labels), ''.join(labels)))
+	for index, (size, bitrate) in enumerate(renditions):
+		filters.append('[stream{0}]{1}[{2}]'.format(index, videoScaleArg(size), videoStreamName(size)))
+	if len(encodeKinds) > 0:
+		encodeLabels = [ '[{0}]'.format(kind) for kind in encodeKinds ]
+		filters.append('[video]{0},split={1}{2}'.format(videoScaleArg(mediaItem['poster'].size()), len(encodeLabels), ''.join(encodeLabels)))
+	if len(stillKinds) > 0:
+		# Exact poster size, raw frame has no header with dimensions
+		filters.append('[stillSource]scale={0}:{1},format=rgb24[still]'.format(mediaItem['poster']['width'], mediaItem['poster']['height']))
+	command = [ ToolFFmpeg ] + FFmpegCommonArgs + [ '-threads', str(threads), '-i', original ]
+	if len(filters) > 0:
+		command += [ '-filter_complex_threads', str(threads), '-filter_complex', ';'.join(filters) ]
+	if len(stillKinds) > 0:
+		command += [ '-map', '[still]', '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1' ]
+	for kind in [ 'mp4', 'ogv', 'webm' ]:
+		if kind not in fileNames:
+			continue
+		if kind in copyKinds:
+			# Streams are copied from original, not from the filter graph
+			logD('Copying video streams of "{0}" to "{1}"'.format(mediaItem['original'], fileNames[kind]))
+			command += [ '-map', '0:v:0', '-map', '0:a:0?' ]
+			command += PassthroughFormats[kind]['args'] + [ temporaryFileName(fileNames[kind]) ]
+		else:
+			command += [ '-map', '[{0}]'.format(kind), '-map', '0:a?' ]
+			command += VideoFormatArgs[kind] + [ '-threads', str(threads), temporaryFileName(fileNames[kind]) ]
+	# Every rendition is a separate HLS output, master playlist is written
+	# when all of them are complete (see runVideoDerivatives())
+	streamFolder = temporaryFileName(fileNames[VideoStreamKind]) if len(renditions) > 0 else None
+	for size, bitrate in renditions:
+		name = videoStreamName(size)
+		command += [ '-map', '[{0}]'.format(name), '-map', '0:a?' ]
+		command += videoStreamArgs(size, bitrate) + [ '-threads', str(threads),
+					'-hls_segment_filename', os.path.join(streamFolder, name + '-%05d.ts'),
+					os.path.join(streamFolder, name + '.m3u8') ]
+	return command
+# Watermark of video thumbnails prepared for compositing, loaded once per
+# process by videoThumbnailWatermark()
+videoThumbnailWatermarkImage = None
+
+def videoThumbnailWatermark():
+	# Returns RGBA watermark image with halved opacity (50% dissolve)
+	global videoThumbnailWatermarkImage
+	if videoThumbnailWatermarkImage is None:
+		with Image.open(VideoThumbnailWatermark, 'r') as image:
+			watermark = image.convert('RGBA')
+		watermark.putalpha(watermark.getchannel('A').point(lambda alpha: alpha // 2))
+		videoThumbnailWatermarkImage = watermark
+	return videoThumbnailWatermarkImage
+
+def createVideoStills(mediaItem, fileNames, frame):
+	# Runs in Pillow worker process
+	# fileNames: dictionary
+	#     Key: derivative kind ('thumbnail' or 'poster')
+	#     Value: output file name
+	# frame: raw RGB still frame of poster size
+	# Returns (created file names, details of created files) tuple, see
+	# createImageDerivatives()
+	createdFileNames = []
+	details = {}
+	image = Image.frombytes('RGB', mediaItem['poster'].size(), frame)
+	for kind in [ 'poster', 'thumbnail' ]:
+		if kind not in fileNames:
+			continue
+		fileName = fileNames[kind]
+		source = mediaItem[kind]
+		try:
+			image.thumbnail(source.size(), Image.Resampling.LANCZOS)
+			still = image
+			if kind == 'thumbnail':
+				# Add video watermark into thumbnail
+				watermark = videoThumbnailWatermark()
+				still = image.copy()
+				still.paste(watermark, ((still.width - watermark.width) // 2, (still.height - watermark.height) // 2), watermark)
+			data, quality = encodeImage(still, imageEncoderSettings(kind, source, 'jpg'), {})
+			writeFileAtomically(fileName, data)
+			if quality is not None:
+				details.setdefault(fileName, {})['settings'] = { 'quality': quality }
+			if kind == 'thumbnail':
+				details.setdefault(fileName, {})['placeholder'] = placeholderDataUri(still)
+			logI('Created "{0}"'.format(fileName))
+			createdFileNames.append(fileName)
+		except Exception as ex:
+			removeFile(temporaryFileName(fileName))
+			logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+	return (createdFileNames, details)
+
+async def runVideoDerivatives(mediaItem, fileNames, scheduler, jobStats, pillowExecutor, details, original):
+	# fileNames: dictionary
+	#     Key: derivative kind ('thumbnail', 'poster', 'mp4', 'ogv', 'webm' or
+	#          'hls' for stream folder)
+	#     Value: output file name
+	# pillowExecutor: process pool creating still images
+	# details: dictionary filled with details of created files, see
+	#     createImageDerivatives()
+	# original: file name of original to read (local copy when staging)
+	# Returns array of successfully created file names
+	videoJobClass = jobClass(mediaItem, fileNames)
+	stillFileNames = { kind: fileNames[kind] for kind in [ 'thumbnail', 'poster' ] if kind in fileNames }
+	journalStart(fileNames.values())
+	threads = await scheduler.acquire(videoJobClass)
 	try:
-		if not argDryRun:
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-vn',
-						'-codec:a', 'libvorbis',
-						'-b:a', '160k', '-ar', '44100', '-ac', '2',
-						'-f', 'ogg', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
-		logI('Created "{0}"'.format(fileName))
+		if VideoStreamKind in fileNames:
+			streamFolder = temporaryFileName(fileNames[VideoStreamKind])
+			removeFile(streamFolder)
+			os.makedirs(streamFolder, mode = 0o755)
+		frame = await runTool(videoDerivativesCommand(mediaItem, fileNames, threads, original), jobStats, len(stillFileNames) > 0)
+		if len(stillFileNames) > 0 and len(frame) != 3 * mediaItem['poster']['width'] * mediaItem['poster']['height']:
+			raise RuntimeError('Unexpected still frame size {0} bytes'.format(len(frame)))
+		if VideoStreamKind in fileNames:
+			writeFileAtomically(os.path.join(streamFolder, VideoStreamPlaylist), videoStreamMasterPlaylist(videoStreamRenditions(mediaItem)))
 	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createVideoThumbnail(mediaItem, fileName):
+		for fileName in fileNames.values():
+			removeFile(temporaryFileName(fileName))
+			logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+		return []
+	finally:
+		scheduler.release(videoJobClass, threads)
+	createdFileNames = []
+	if len(stillFileNames) > 0:
+		threads = await scheduler.acquire('thumbnail' if 'thumbnail' in stillFileNames else 'poster', 1)
+		try:
+			wallStart = time.monotonic()
+			stillCreatedFileNames, stillDetails = await asyncio.get_running_loop().run_in_executor(pillowExecutor,
+				createVideoStills, mediaItem, stillFileNames, frame)
+			jobStats['wallTime'] += time.monotonic() - wallStart
+			createdFileNames += stillCreatedFileNames
+			details.update(stillDetails)
+		except Exception as ex:
+			for fileName in stillFileNames.values():
+				logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+		finally:
+			scheduler.release('thumbnail' if 'thumbnail' in stillFileNames else 'poster', threads)
+	for kind in [ 'mp4', 'ogv', 'webm', VideoStreamKind ]:
+		if kind not in fileNames:
+			continue
+		fileName = fileNames[kind]
+		try:
+			if kind == VideoStreamKind:
+				# Folder cannot be replaced by rename, old stream is removed first
+				removeFile(fileName)
+			os.replace(temporaryFileName(fileName), fileName)
+			logI('Created "{0}"'.format(fileName))
+			createdFileNames.append(fileName)
+		except Exception as ex:
+			removeFile(temporaryFileName(fileName))
+			logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
+	return createdFileNames
+
+#*** Derivative manifest
+# Manifest records for every created derivative the fingerprint of its original
+# and the digest of encoding parameters it was created with. Derivatives with
+# a different original fingerprint or parameters (or without record at all,
+# e.g. half-written by killed run) are stale and get re-generated.
+ManifestVersion = 1
+
+# Key: derivative file name with path relative to root folder
+# Value: dictionary with keys 'source' (fingerprint of original or None when
+#        unknown), 'params' (digest of encoding parameters or None), 'bytes'
+#        and optionally 'link' (file name of derivative of identical original
+#        the file is linked to, see linkDerivative())
+manifest = {}
+manifestChanged = False
+
+# Digests of generated JSON and RSS documents, see storeToFile()
+# Key: document file name with path relative to root folder
+# Value: SHA-1 digest of document content
+documentDigests = {}
+
+# Manifest records and document digests as last seen in site metadata folder
+# (loaded, stored or pushed when staging), changes of other runs made since
+# then are merged by mergeManifest()
+storedManifest = {}
+storedDocumentDigests = {}
+
+def readManifest(filePath):
+	# Returns tuple (manifest records, document digests), None for manifest
+	# with different version
+	with open(filePath, 'r') as f:
+		data = json.load(f)
+	if data.get('version') != ManifestVersion:
+		return None
+	return (data['files'], data.get('documents', {}))
+
+def loadManifest():
+	# Returns False when there is no manifest yet
+	global manifest, documentDigests, storedManifest, storedDocumentDigests
+	filePath = os.path.join(SiteMetaData, ManifestFile)
 	try:
-		if not argDryRun:
-			scale = videoScaleArg(mediaItem['thumbnail'].size())
-			# Create thumbnail
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-filter:v', scale, '-ss', '00:00:00', '-frames:v', '1',
-						'-r', '1', '-q:v', '1',
-						'-f', 'image2', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
-			# Add video watermark into thumbnail
-			command = [ ToolComposite, '-dissolve', '50%', '-gravity', 'center',
-						VideoThumbnailWatermark, fileName, fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
-		logI('Created "{0}"'.format(fileName))
+		data = readManifest(filePath)
+		if data is None:
+			logW('Ignored manifest "{0}" with different version'.format(filePath))
+			return False
+		manifest, documentDigests = data
+		storedManifest, storedDocumentDigests = dict(manifest), dict(documentDigests)
+		logD('Loaded {0} manifest records'.format(len(manifest)))
+		return True
+	except FileNotFoundError:
+		return False
 	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createVideoPoster(mediaItem, fileName):
+		logW('Ignored unreadable manifest "{0}" ({1})'.format(filePath, str(ex)))
+		return False
+
+def mergeRecords(records, storedRecords, publishedRecords):
+	# Records changed (or removed) by other run only are taken from published
+	# manifest, records changed by this run win. Keys are file names, file
+	# created again by this run keeps its record even if it is the same one.
+	for key in set(storedRecords.keys()) | set(publishedRecords.keys()):
+		storedRecord = storedRecords.get(key)
+		publishedRecord = publishedRecords.get(key)
+		if records.get(key) != storedRecord or publishedRecord == storedRecord:
+			continue
+		if publishedRecord is None:
+			if key in records and not os.path.lexists(stagedOrPublishedPath(key)):
+				del records[key]
+		else:
+			records[key] = publishedRecord
+
+def mergeManifest():
+	# Merges changes of other runs stored since the manifest was loaded or
+	# stored by this run (e.g. records of media files deleted meanwhile by
+	# deleting unreferenced media), must run with site metadata lock held
+	global manifestChanged, storedManifest, storedDocumentDigests
+	filePath = publishedPath(os.path.join(SiteMetaData, ManifestFile))
 	try:
-		if not argDryRun:
-			scale = videoScaleArg(mediaItem['poster'].size())
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-filter:v', scale, '-ss', '00:00:00', '-frames:v', '1',
-						'-r', '1', '-q:v', '1',
-						'-f', 'image2', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
-		logI('Created "{0}"'.format(fileName))
+		data = readManifest(filePath)
+	except FileNotFoundError:
+		return
 	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createVideoMp4(mediaItem, fileName):
+		logW('Ignored unreadable manifest "{0}" ({1})'.format(filePath, str(ex)))
+		return
+	if data is None:
+		return
+	publishedManifest, publishedDocumentDigests = data
+	if publishedManifest == storedManifest and publishedDocumentDigests == storedDocumentDigests:
+		return
+	mergeRecords(manifest, storedManifest, publishedManifest)
+	mergeRecords(documentDigests, storedDocumentDigests, publishedDocumentDigests)
+	storedManifest, storedDocumentDigests = publishedManifest, publishedDocumentDigests
+	manifestChanged = True
+	logD('Merged manifest records stored by other run')
+
+def manifestPublished():
+	# Called when manifest is written to site metadata folder
+	global storedManifest, storedDocumentDigests
+	storedManifest, storedDocumentDigests = dict(manifest), dict(documentDigests)
+
+def storeManifest():
+	# Manifest is stored with site metadata lock held, so that records
+	# removed by concurrent deleting of unreferenced media are not restored
+	# (pushed by syncStage() when staging)
+	global manifestChanged
+	if not manifestChanged or argDryRun:
+		return
+	with siteMetaDataLock(fcntl.LOCK_SH):
+		mergeManifest()
+		data = {}
+		data['version'] = ManifestVersion
+		data['files'] = manifest
+		data['documents'] = documentDigests
+		filePath = os.path.join(SiteMetaData, ManifestFile)
+		try:
+			os.makedirs(SiteMetaData, mode = 0o755, exist_ok = True)
+			writeFileAtomically(filePath, json.dumps(data, separators = (',', ':'), sort_keys = True))
+			if stageRoot is None:
+				manifestPublished()
+			manifestChanged = False
+			logD('Stored {0} manifest records'.format(len(manifest)))
+		except Exception as ex:
+			logE('Cannot write manifest "{0}" ({1})'.format(filePath, str(ex)))
+
+def manifestRecord(fileName, source, params, details = None):
+	# details: dictionary with additional record items, e.g. 'settings'
+	#     (encoder settings chosen for the file like quality fitting byte
+	#     budget) or 'placeholder' (data URI, for thumbnails)
+	global manifestChanged
+	record = {}
+	record['source'] = source
+	record['params'] = params
+	if details is not None:
+		record.update(details)
 	try:
-		if not argDryRun:
-			scale = videoScaleArg(mediaItem['poster'].size())
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-filter:v', scale,
-						'-codec:v', 'libx264',
-						'-b:v', '500k',
-						'-codec:a', 'aac',
-						'-b:a', '160k', '-ar', '44100', '-ac', '2',
-						'-f', 'mp4', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
-		logI('Created "{0}"'.format(fileName))
-	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createVideoOgv(mediaItem, fileName):
+		record['bytes'] = pathSize(stagedOrPublishedPath(fileName))
+	except OSError:
+		record['bytes'] = 0
+	manifest[fileName] = record
+	manifestChanged = True
+	journalWrite({ 'done': fileName, 'record': record })
+
+#*** Job journal
+# Manifest is stored at the end of media generation only. To not lose work
+# of a killed run, every started job and every created derivative is appended
+# to the journal immediately. Next run replays finished derivatives into the
+# manifest and removes temporary files of jobs that did not finish.
+
+journal = None # Open journal file (only while media are generated)
+
+def openJournal():
+	global journal
+	if not argDryRun:
+		journal = open(os.path.join(SiteMetaData, JournalFile), 'a')
+
+def closeJournal():
+	# Journal is not needed anymore once manifest is stored
+	global journal
+	if journal is not None:
+		journal.close()
+		journal = None
+		if not manifestChanged:
+			removeFile(os.path.join(SiteMetaData, JournalFile))
+
+def journalWrite(entry):
+	if journal is not None:
+		journal.write(json.dumps(entry, separators = (',', ':'), sort_keys = True) + '\n')
+		journal.flush()
+
+def journalSync():
+	if journal is not None:
+		os.fsync(journal.fileno())
+
+def journalStart(fileNames):
+	journalWrite({ 'start': list(fileNames) })
+
+def replayJournal():
+	global manifestChanged
+	filePath = os.path.join(SiteMetaData, JournalFile)
 	try:
-		if not argDryRun:
-			scale = videoScaleArg(mediaItem['poster'].size())
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-filter:v', scale,
-						'-codec:v', 'libtheora',
-						'-b:v', '500k',
-						'-codec:a', 'libvorbis',
-						'-b:a', '160k', '-ar', '44100', '-ac', '2',
-						'-f', 'ogg', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
-		logI('Created "{0}"'.format(fileName))
-	except Exception as ex:
-		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-def createVideoWebm(mediaItem, fileName):
+		with open(filePath, 'r') as f:
+			lines = f.readlines()
+	except FileNotFoundError:
+		return
+	unfinishedFileNames = set()
+	finishedCount = 0
+	for line in lines:
+		try:
+			entry = json.loads(line)
+		except ValueError:
+			continue # Last line of killed run may be incomplete
+		if 'start' in entry:
+			unfinishedFileNames.update(entry['start'])
+		elif 'done' in entry:
+			unfinishedFileNames.discard(entry['done'])
+			manifest[entry['done']] = entry['record']
+			manifestChanged = True
+			finishedCount += 1
+	logI('Recovered {0} files created by interrupted run'.format(finishedCount))
+	if not argDryRun:
+		for fileName in unfinishedFileNames:
+			removeFile(temporaryFileName(fileName))
+		storeManifest()
+		if not manifestChanged:
+			removeFile(filePath)
+
+def paramsDigest(params):
+	data = json.dumps(params, separators = (',', ':'), sort_keys = True)
+	return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+def mediaDerivatives(mediaItem):
+	# Returns dictionary
+	#     Key: derivative kind
+	#     Value: (file name, digest of encoding parameters) tuple
+	derivatives = {}
+	base = os.path.join(SiteMetaData, Galleries, mediaItem['galleryId'], mediaItem['id'])
+	if mediaItem['type'] == 'Image':
+		for kind, (source, fileExt) in imageDerivatives(mediaItem).items():
+			settings = imageEncoderSettings(kind, source, fileExt)
+			params = { 'size': source.size(), 'format': settings['format'], 'options': settings['options'] }
+			if fileExt == 'jpg':
+				params['maxBytes'] = settings['maxBytes']
+				params['stripMetadata'] = settings['stripMetadata']
+				if kind == 'thumbnail':
+					params['placeholder'] = [ PlaceholderSize, PlaceholderQuality ]
+				derivatives[kind] = (source['path'], paramsDigest(params))
+			else:
+				derivatives[kind] = (alternativeImagePath(source['path'], fileExt), paramsDigest(params))
+	elif mediaItem['type'] == 'Video':
+		for kind in [ 'thumbnail', 'poster' ]:
+			settings = imageEncoderSettings(kind, mediaItem[kind], 'jpg')
+			params = { 'size': mediaItem[kind].size(), 'format': settings['format'], 'options': settings['options'] }
+			params['maxBytes'] = settings['maxBytes']
+			params['stripMetadata'] = settings['stripMetadata']
+			if kind == 'thumbnail':
+				params['watermark'] = VideoThumbnailWatermark
+				params['placeholder'] = [ PlaceholderSize, PlaceholderQuality ]
+			derivatives[kind] = (mediaItem[kind]['path'], paramsDigest(params))
+		for kind in VideoFormatArgs.keys():
+			params = { 'size': mediaItem['poster'].size(), 'args': VideoFormatArgs[kind] }
+			if isPassthrough(mediaItem, kind):
+				params = { 'copy': PassthroughFormats[kind] }
+			derivatives[kind] = (base + '.' + kind, paramsDigest(params))
+		if len(VideoStreamLadder) > 0:
+			renditions = videoStreamRenditions(mediaItem)
+			params = { 'renditions': [ [ size.width, size.height, videoStreamArgs(size, bitrate) ] for size, bitrate in renditions ] }
+			derivatives[VideoStreamKind] = (videoStreamFolder(mediaItem), paramsDigest(params))
+	elif mediaItem['type'] == 'Audio':
+		for kind in AudioFormatArgs.keys():
+			params = { 'args': AudioFormatArgs[kind] }
+			if isPassthrough(mediaItem, kind):
+				params = { 'copy': PassthroughFormats[kind] }
+			derivatives[kind] = (base + '.' + kind, paramsDigest(params))
+	return derivatives
+
+def staleDerivatives(mediaItem):
+	# Returns dictionary
+	#     Key: derivative kind
+	#     Value: file name of missing or outdated derivative
+	fileNames = {}
+	derivatives = mediaDerivatives(mediaItem)
+	if len(derivatives) == 0:
+		return fileNames
+	source = cachedFingerprint(mediaItem['original'])
+	for kind, (fileName, params) in derivatives.items():
+		record = manifest.get(fileName)
+		if record is None or record['source'] != source or record['params'] != params:
+			fileNames[kind] = fileName
+	return fileNames
+
+def adoptExistingDerivatives(galleriesIn):
+	# Creates manifest records for files created before the manifest existed.
+	# Files matching derivatives of existing originals are considered up to date,
+	# other files are recorded with unknown source and parameters.
+	logI('Creating manifest from existing files in "{0}"...'.format(os.path.join(os.getcwd(), SiteMetaData, Galleries)))
+	expected = {}
+	for galleryId in galleriesIn.keys():
+		for itemId in galleriesIn[galleryId].keys():
+			mediaItem = galleriesIn[galleryId][itemId]
+			for fileName, params in mediaDerivatives(mediaItem).values():
+				expected[fileName] = (mediaItem, params)
+	galleriesPath = os.path.join(SiteMetaData, Galleries)
+	if not os.path.isdir(publishedPath(galleriesPath)):
+		return
+	for galleryName in sorted(os.listdir(publishedPath(galleriesPath))):
+		galleryPath = os.path.join(galleriesPath, galleryName)
+		if not os.path.isdir(publishedPath(galleryPath)):
+			continue
+		for name in sorted(os.listdir(publishedPath(galleryPath))):
+			fileName = os.path.join(galleryPath, name)
+			if not os.path.isfile(publishedPath(fileName)):
+				continue
+			if fileName in expected.keys():
+				mediaItem, params = expected[fileName]
+				manifestRecord(fileName, cachedFingerprint(mediaItem['original']), params)
+			else:
+				manifestRecord(fileName, None, None)
+	logI('Recorded {0} existing files'.format(len(manifest)))
+
+def derivativeItemId(name):
+	# File name starts with digits followed at least by a dot
+	return re.sub(r'^([0-9]+)\..*$', r'\1', os.path.splitext(name)[0])
+
+def galleriesOutFromManifest():
+	# Returns galleriesOut dictionary (see main) created from manifest records
+	galleriesOut = {}
+	galleriesPath = os.path.join(SiteMetaData, Galleries)
+	for fileName in sorted(manifest.keys()):
+		folderName, name = os.path.split(fileName)
+		if os.path.dirname(folderName) != galleriesPath:
+			continue
+		galleryId = os.path.basename(folderName)
+		itemId = derivativeItemId(name)
+		galleriesOut.setdefault(galleryId, {}).setdefault(itemId, []).append(name)
+	return galleriesOut
+
+#*** Thumbnail sprites
+
+def thumbnailSprites(galleryId, galleryItems):
+	# galleryItems: dictionary of media items of the gallery (key: item ID)
+	# Returns dictionary
+	#     Key: sprite sheet file name (with digest of sheet content, changed
+	#          sheet gets new URL and stale one cached by browsers is not used)
+	#     Value: (digest of sheet content, array of media items in sheet order) tuple
+	# Only items with up to date thumbnails are put to sheets. Items without
+	# numeric ID (e.g. "photo.jpg") have no bucket, they keep plain thumbnails.
+	buckets = {}
+	readyIds = galleryReadyItemIds(galleryId, galleryItems)
+	for itemId in sorted(galleryItems.keys()):
+		mediaItem = galleryItems[itemId]
+		if not itemId.isascii() or not itemId.isdigit():
+			continue
+		if mediaItem['type'] not in [ 'Image', 'Video' ] or itemId not in readyIds:
+			continue
+		buckets.setdefault(int(itemId) // ThumbnailSpriteSize, []).append(mediaItem)
+	sprites = {}
+	for bucket, mediaItems in buckets.items():
+		content = {}
+		content['layout'] = [ ThumbnailSpriteColumns, MaxThumbnailWidth, MaxThumbnailHeight, ImageEncoderProfiles['thumbnail'] ]
+		content['items'] = []
+		for mediaItem in mediaItems:
+			record = manifest[mediaItem['thumbnail']['path']]
+			content['items'].append([ mediaItem['id'], mediaItem['thumbnail'], record['source'], record['params'] ])
+		digest = paramsDigest(content)
+		fileName = os.path.join(SiteMetaData, Galleries, galleryId, ThumbnailSprites, '{0}-{1}.jpg'.format(bucket, digest))
+		sprites[fileName] = (digest, mediaItems)
+	return sprites
+
+def spritePosition(index):
+	# Returns (x, y) tuple, position of index-th thumbnail in sprite sheet
+	return ((index % ThumbnailSpriteColumns) * MaxThumbnailWidth, (index // ThumbnailSpriteColumns) * MaxThumbnailHeight)
+
+def itemSprites(galleryId, galleryItems):
+	# Returns dictionary with thumbnail positions in up to date sprite sheets
+	#     Key: item ID
+	#     Value: dictionary with keys 'path', 'x' and 'y'
+	positions = {}
+	if ThumbnailSpriteSize <= 0:
+		return positions
+	for fileName, (digest, mediaItems) in thumbnailSprites(galleryId, galleryItems).items():
+		record = manifest.get(fileName)
+		if record is None or record['source'] != digest:
+			continue
+		for index, mediaItem in enumerate(mediaItems):
+			x, y = spritePosition(index)
+			positions[mediaItem['id']] = { 'path': fileName, 'x': x, 'y': y }
+	return positions
+
+def createSpriteSheet(fileName, thumbnails):
+	# thumbnails: array of (file name, Size) tuples in sheet order
+	# Returns True on success
 	try:
-		if not argDryRun:
-			scale = videoScaleArg(mediaItem['poster'].size())
-			command = [ ToolFFmpeg, '-i', mediaItem['original'],
-						'-filter:v', scale,
-						'-codec:v', 'libvpx',
-						'-b:v', '500k',
-						'-codec:a', 'libvorbis',
-						'-b:a', '160k', '-ar', '44100', '-ac', '2',
-						'-f', 'webm', fileName ]
-			subprocess.check_call(command, stderr = subprocess.DEVNULL)
+		columns = min(len(thumbnails), ThumbnailSpriteColumns)
+		rows = (len(thumbnails) + ThumbnailSpriteColumns - 1) // ThumbnailSpriteColumns
+		sheet = Image.new('RGB', (columns * MaxThumbnailWidth, rows * MaxThumbnailHeight), (255, 255, 255))
+		for index, (thumbnailFileName, size) in enumerate(thumbnails):
+			with Image.open(thumbnailFileName, 'r') as thumbnail:
+				thumbnail = thumbnail.convert('RGB')
+				if thumbnail.size != size:
+					thumbnail = thumbnail.resize(size, Image.Resampling.LANCZOS) # Browser shows it in size from metadata
+				sheet.paste(thumbnail, spritePosition(index))
+		settings = imageEncoderSettings('thumbnail', None, 'jpg')
+		settings['maxBytes'] = None # Budget is for single thumbnails
+		data, quality = encodeImage(sheet, settings, {})
+		writeFileAtomically(fileName, data)
 		logI('Created "{0}"'.format(fileName))
+		return True
 	except Exception as ex:
+		removeFile(temporaryFileName(fileName))
 		logE('Cannot write to "{0}" ({1})'.format(os.path.join(os.getcwd(), fileName), str(ex)))
-
-def generateMedia(galleriesIn, galleriesOut, galleryNames):
-	def createFileFuture(fn, galleryId, itemId, fileName):
-		if galleryId not in galleriesOut.keys() or itemId not in galleriesOut[galleryId].keys() or os.path.split(fileName)[1] not in galleriesOut[galleryId][itemId]:
+		return False
+
+def generateThumbnailSprites(galleriesIn):
+	# Creates outdated sprite sheets, superseded ones are removed by
+	# removeUnusedSprites() once galleries are published with the new ones
+	# Returns array of IDs of galleries with changed sprite sheets
+	if ThumbnailSpriteSize <= 0:
+		return []
+	changedGalleryIds = set()
+	jobs = [] # Array of (gallery ID, sheet file name, digest, thumbnails) tuples
+	for galleryId in sorted(galleriesIn.keys()):
+		sprites = thumbnailSprites(galleryId, galleriesIn[galleryId])
+		for fileName, (digest, mediaItems) in sorted(sprites.items()):
+			record = manifest.get(fileName)
+			if record is None or record['source'] != digest:
+				thumbnails = [ (stagedOrPublishedPath(mediaItem['thumbnail']['path']), mediaItem['thumbnail'].size()) for mediaItem in mediaItems ]
+				jobs.append((galleryId, fileName, digest, thumbnails))
+	for galleryId in sorted(set([ job[0] for job in jobs ])):
+		os.makedirs(os.path.join(SiteMetaData, Galleries, galleryId, ThumbnailSprites), mode = 0o755, exist_ok = True)
+	journalStart([ job[1] for job in jobs ])
+	with concurrent.futures.ProcessPoolExecutor(max_workers = PillowWorkers) as executor:
+		results = executor.map(createSpriteSheet, [ job[1] for job in jobs ], [ job[3] for job in jobs ])
+		for (galleryId, fileName, digest, thumbnails), created in zip(jobs, results):
+			if created:
+				manifestRecord(fileName, digest, None)
+				changedGalleryIds.add(galleryId)
+	journalSync()
+	return sorted(changedGalleryIds)
+
+#*** Shared derivatives of identical originals
+# The same original is often placed to several galleries (e.g. "best of"
+# galleries). Derivatives are created for one of identical originals only and
+# the others get hard links to them, so a duplicated video costs one transcode
+# and one set of output bytes. Originals with equal fingerprints are read whole
+# to verify they are identical.
+
+def identicalOriginals(galleriesIn):
+	# Returns dictionary
+	#     Key: original file name
+	#     Value: array of media items with identical originals (including the
+	#            item itself) sorted by original file name
+	sameFingerprint = {}
+	for galleryId in sorted(galleriesIn.keys()):
+		for itemId in sorted(galleriesIn[galleryId].keys()):
+			mediaItem = galleriesIn[galleryId][itemId]
+			# Known fingerprints are not verified again, originals of galleries
+			# not updated now (see --watch) are not touched this way
+			fingerprint = probeCache.get(mediaItem['original'], {}).get('fingerprint') or cachedFingerprint(mediaItem['original'])
+			sameFingerprint.setdefault(fingerprint, []).append(mediaItem)
+	candidates = [ mediaItem for mediaItems in sameFingerprint.values() if len(mediaItems) > 1 for mediaItem in mediaItems ]
+	with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+		digests = list(executor.map(cachedContentDigest, [ mediaItem['original'] for mediaItem in candidates ]))
+	sameDigest = {}
+	for mediaItem, digest in zip(candidates, digests):
+		sameDigest.setdefault(digest, []).append(mediaItem)
+	identical = {}
+	for mediaItems in sameDigest.values():
+		if len(mediaItems) < 2:
+			continue
+		mediaItems.sort(key = lambda mediaItem: mediaItem['original'])
+		for mediaItem in mediaItems:
+			identical[mediaItem['original']] = mediaItems
+	return identical
+
+def sharedDerivative(mediaItem, kind, identicalItems):
+	# Returns file name of up to date derivative of the same kind and encoding
+	# parameters created for identical original, None when there is none
+	fileName, params = mediaDerivatives(mediaItem)[kind]
+	for otherItem in identicalItems:
+		otherFileName, otherParams = mediaDerivatives(otherItem).get(kind, (None, None))
+		if otherFileName == fileName or otherParams != params:
+			continue
+		record = manifest.get(otherFileName)
+		if record is not None and record['source'] == cachedFingerprint(otherItem['original']) and record['params'] == params:
+			return otherFileName
+	return None
+
+def linkOrCopyFile(source, target):
+	# Copy is made when hard link is not possible (e.g. staged output linked
+	# to file in site metadata folder on other file system), such copy is
+	# linked again when stage is synced, see pushStagedLink()
+	try:
+		os.link(source, target)
+	except OSError:
+		shutil.copyfile(source, target)
+
+def linkDerivative(mediaItem, kind, sourceName):
+	# Creates derivative as hard link of derivative sourceName of identical
+	# original. Derivatives are always replaced by rename, never rewritten in
+	# place, so linked files stay independent.
+	# Returns True when linked
+	fileName, params = mediaDerivatives(mediaItem)[kind]
+	if not argDryRun:
+		source = stagedOrPublishedPath(sourceName)
+		try:
+			removeFile(temporaryFileName(fileName))
+			if os.path.isdir(source):
+				shutil.copytree(source, temporaryFileName(fileName), copy_function = linkOrCopyFile)
+				# Folder cannot be replaced by rename, old one is removed first
+				removeFile(fileName)
+			else:
+				linkOrCopyFile(source, temporaryFileName(fileName))
+			os.replace(temporaryFileName(fileName), fileName)
+		except Exception as ex:
+			removeFile(temporaryFileName(fileName))
+			logE('Cannot link "{0}" to "{1}" ({2})'.format(fileName, sourceName, str(ex)))
+			return False
+		details = { key: value for key, value in manifest[sourceName].items() if key not in [ 'source', 'params', 'bytes' ] }
+		details['link'] = sourceName
+		manifestRecord(fileName, cachedFingerprint(mediaItem['original']), params, details)
+	logI('Linked "{0}" to "{1}"'.format(fileName, sourceName))
+	return True
+
+def linkDerivatives(links):
+	# links: array of (mediaItem, kind, source file name) tuples
+	# Returns set of IDs of galleries with linked thumbnails
+	galleryIds = set()
+	for mediaItem, kind, sourceName in links:
+		if linkDerivative(mediaItem, kind, sourceName) and kind == 'thumbnail':
+			galleryIds.add(mediaItem['galleryId'])
+			if not argDryRun:
+				markMediaItemReady(mediaItem)
+	journalSync()
+	return galleryIds
+
+def removeUnusedSprites(galleriesIn):
+	# Removes sprite sheets not used by published galleries anymore (like
+	# stale pages, see removeGalleryPages())
+	global manifestChanged
+	if ThumbnailSpriteSize <= 0:
+		return
+	for galleryId in sorted(galleriesIn.keys()):
+		sprites = thumbnailSprites(galleryId, galleriesIn[galleryId])
+		spritesPath = os.path.join(SiteMetaData, Galleries, galleryId, ThumbnailSprites)
+		for fileName in sorted([ fileName for fileName in manifest.keys() if os.path.dirname(fileName) == spritesPath and fileName not in sprites ]):
 			if not argDryRun:
-				future = executor.submit(fn, galleriesIn[galleryId][itemId], fileName)
-				futures[future] = fileName
+				removeFile(fileName)
+				del manifest[fileName]
+				manifestChanged = True
+			logI('Removed "{0}"'.format(fileName))
+
+def recordDerivatives(jobs, createdFileNames, details = {}):
+	# jobs: array of (mediaItem, fileNames) tuples
+	# details: dictionary with details of created files (key: file name), see
+	#     createImageDerivatives()
+	for mediaItem, fileNames in jobs:
+		derivatives = mediaDerivatives(mediaItem)
+		source = cachedFingerprint(mediaItem['original'])
+		for kind, fileName in fileNames.items():
+			if fileName in createdFileNames:
+				manifestRecord(fileName, source, derivatives[kind][1], details.get(fileName))
+				if kind == 'thumbnail':
+					markMediaItemReady(mediaItem)
+	journalSync()
+
+async def runMediaJobs(imageBatches, toolJobs, onGalleryThumbnailsDone):
+	# imageBatches: array of arrays of (mediaItem, fileNames) tuples
+	# toolJobs: array of (mediaItem, fileNames) tuples for audio and video
+	# onGalleryThumbnailsDone: function called with gallery ID as soon as all
+	#     thumbnail jobs of the gallery are finished
+	# Returns set of IDs of galleries with newly created video streams
+	loop = asyncio.get_running_loop()
+	scheduler = JobScheduler(CpuThreads)
+	pillowWorkersFree = asyncio.Semaphore(PillowWorkers)
+
+	async def localOriginal(mediaItem):
+		# Returns file name of original to read, local copy when staging
+		if originalCache is None:
+			return mediaItem['original']
+		return await originalCache.localOriginal(mediaItem)
+
+	async def releaseOriginal(mediaItem):
+		if originalCache is not None:
+			await originalCache.release(mediaItem)
+
+	async def runImageBatch(batch):
+		# Returns array of (mediaItem, fileNames, created file names, job statistics,
+		# details of created files) tuples
+		imageJobClass = batchJobClass(batch)
+		# Worker reads originals from copies of media items
+		workerBatch = []
+		for mediaItem, fileNames in batch:
+			workerItem = MediaItem()
+			dict.update(workerItem, mediaItem)
+			workerItem['original'] = await localOriginal(mediaItem)
+			workerBatch.append((workerItem, fileNames))
+		try:
+			async with pillowWorkersFree:
+				threads = await scheduler.acquire(imageJobClass, 1)
+				journalStart([ fileName for mediaItem, fileNames in batch for fileName in fileNames.values() ])
+				try:
+					results = await loop.run_in_executor(pillowExecutor, createImageDerivativesBatch, workerBatch)
+				except Exception as ex:
+					logE('Image operation failed ({0})'.format(str(ex)))
+					results = [ ([], { 'wallTime': 0.0, 'cpuTime': 0.0 }, {}) for job in batch ]
+				finally:
+					scheduler.release(imageJobClass, threads)
+		finally:
+			for mediaItem, fileNames in batch:
+				await releaseOriginal(mediaItem)
+		return [ (mediaItem, fileNames) + result for (mediaItem, fileNames), result in zip(batch, results) ]
+
+	async def runToolJob(mediaItem, fileNames):
+		jobStats = { 'wallTime': 0.0, 'cpuTime': 0.0 }
+		details = {}
+		original = await localOriginal(mediaItem)
+		try:
+			if mediaItem['type'] == 'Audio':
+				createdFileNames = await runAudioDerivatives(mediaItem, fileNames, scheduler, jobStats, original)
 			else:
-				logI('Created "{0}"'.format(fileName))
-
+				createdFileNames = await runVideoDerivatives(mediaItem, fileNames, scheduler, jobStats, pillowExecutor, details, original)
+		finally:
+			await releaseOriginal(mediaItem)
+		return [ (mediaItem, fileNames, createdFileNames, jobStats, details) ]
+
+	# Key: gallery ID
+	# Value: number of unfinished jobs creating thumbnails
+	pendingThumbnails = {}
+	allJobs = [ job for batch in imageBatches for job in batch ] + toolJobs
+	for mediaItem, fileNames in allJobs:
+		if 'thumbnail' in fileNames:
+			pendingThumbnails[mediaItem['galleryId']] = pendingThumbnails.get(mediaItem['galleryId'], 0) + 1
+
+	# Progress is estimated from size of processed originals
+	bytesTotal = sum([ originalSize(mediaItem) for mediaItem, fileNames in allJobs ])
+	bytesDone = 0
+	jobsDone = 0
+	wallStart = time.monotonic()
+	lastProgress = 0
+	streamGalleryIds = set()
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers = PillowWorkers) as pillowExecutor, \
+			concurrent.futures.ThreadPoolExecutor(max_workers = StageFetchThreads) as fetchExecutor:
+		if originalCache is not None:
+			# Originals are copied in order batches are expected to run,
+			# audio and video jobs run alone
+			fetchOrder = sorted(imageBatches + [ [ job ] for job in toolJobs ], key = lambda batch: JobClasses[batchJobClass(batch)]['priority'])
+			prefetchTask = asyncio.ensure_future(originalCache.prefetch(fetchOrder, fetchExecutor))
+		tasks = [ runImageBatch(batch) for batch in imageBatches ]
+		tasks += [ runToolJob(mediaItem, fileNames) for mediaItem, fileNames in toolJobs ]
+		logD('{0} operations queued'.format(str(len(tasks))))
+		for task in asyncio.as_completed(tasks):
+			for mediaItem, fileNames, createdFileNames, jobStats, details in await task:
+				recordDerivatives([ (mediaItem, fileNames) ], createdFileNames, details)
+				jobStats['bytesIn'] = originalSize(mediaItem)
+				runReport.addJob(jobClass(mediaItem, fileNames), mediaItem, fileNames, createdFileNames, jobStats)
+				jobsDone += 1
+				bytesDone += jobStats['bytesIn']
+				if VideoStreamKind in fileNames and fileNames[VideoStreamKind] in createdFileNames:
+					streamGalleryIds.add(mediaItem['galleryId'])
+				if 'thumbnail' in fileNames:
+					galleryId = mediaItem['galleryId']
+					pendingThumbnails[galleryId] -= 1
+					if pendingThumbnails[galleryId] == 0:
+						onGalleryThumbnailsDone(galleryId)
+			# Show progress
+			now = time.monotonic()
+			if sys.stderr.isatty() or now - lastProgress >= ProgressLogInterval or jobsDone == len(allJobs):
+				lastProgress = now
+				ratio = bytesDone / bytesTotal if bytesTotal > 0 else jobsDone / len(allJobs)
+				eta = '?'
+				if ratio > 0:
+					eta = str(datetime.timedelta(seconds = round((now - wallStart) * (1 - ratio) / ratio)))
+				logProgress('{0}/{1} jobs, {2:.1f} % done, ETA {3}'.format(jobsDone, len(allJobs), 100 * ratio, eta))
+		if originalCache is not None:
+			await prefetchTask
+	clearProgress()
+	return streamGalleryIds
+
+def originalSize(mediaItem):
+	return probeCacheRecord(mediaItem['original'])['size']
+
+def generateMedia(galleriesIn, galleriesOut, galleryNames, onGalleryThumbnailsDone = lambda galleryId: None, galleryIds = None):
+	# galleryIds: IDs of galleries to create media for, all when None
 	logI('')
 	logI('>>>>> Creating media metadata files started...')
-
-	# Collect futures for parallel execution
-	if not argDryRun:
-		#executor = concurrent.futures.ProcessPoolExecutor(max_workers = 1) # TODO: Remove parameter to use all CPUs?
-		executor = concurrent.futures.ProcessPoolExecutor()
-		futures = {}
+	if galleryIds is None:
+		galleryIds = galleriesIn.keys()
+	galleryIds = sorted(galleryIds)
 
 	# Create missing folders
-	for galleryId in sorted([ galId for galId in galleriesIn.keys() if galId not in galleriesOut.keys() ]):
+	for galleryId in galleryIds:
 		galleryPath = os.path.join(SiteMetaData, Galleries, galleryId)
 		if not os.path.isdir(galleryPath):
 			if not argDryRun:
 				os.makedirs(galleryPath, mode = 0o755, exist_ok = True)
-			logI('Created folder "{0}"'.format(galleryPath))
-
-	# Create features for missing items/files
-	for galleryId in sorted(galleriesIn.keys()):
+			if not os.path.isdir(publishedPath(galleryPath)):
+				logI('Created folder "{0}"'.format(galleryPath))
+
+	# Identical originals are searched in all galleries, derivatives can be
+	# shared with galleries not updated now
+	identical = identicalOriginals(galleriesIn)
+	links = [] # Array of (mediaItem, kind, source file name) tuples, see linkDerivatives()
+	pendingLinks = [] # The same, to link once derivatives are created by queued jobs
+	# Key: (content digest, kind, digest of encoding parameters)
+	# Value: file name of derivative created by queued job
+	sharedFileNames = {}
+
+	# Collect jobs for missing or outdated items/files
+	imageJobs = []
+	toolJobs = []
+	for galleryId in galleryIds:
 		for itemId in sorted(galleriesIn[galleryId]):
 			mediaItem = galleriesIn[galleryId][itemId]
-			mediaItemBasePath = os.path.join(SiteMetaData, Galleries, galleryId, itemId)
-			if mediaItem['type'] == 'Image':
-				createFileFuture(createImageThumbnail, galleryId, itemId, mediaItem['thumbnail']['path'])
-				createFileFuture(createImagePoster, galleryId, itemId, mediaItem['poster']['path'])
-			if mediaItem['type'] == 'Audio':
-				createFileFuture(createAudioMp3, galleryId, itemId, mediaItemBasePath + '.mp3')
-				createFileFuture(createAudioOgg, galleryId, itemId, mediaItemBasePath + '.ogg')
-			if mediaItem['type'] == 'Video':
-				createFileFuture(createVideoThumbnail, galleryId, itemId, mediaItem['thumbnail']['path'])
-				createFileFuture(createVideoPoster, galleryId, itemId, mediaItem['poster']['path'])
-				createFileFuture(createVideoMp4, galleryId, itemId, mediaItemBasePath + '.mp4')
-				createFileFuture(createVideoOgv, galleryId, itemId, mediaItemBasePath + '.ogv')
-				createFileFuture(createVideoWebm, galleryId, itemId, mediaItemBasePath + '.webm')
-
-	# Wait for finishing all operations
-	if not argDryRun:
-		logD('{0} operations queued'.format(str(len(futures))))
-		concurrent.futures.wait(futures)
+			fileNames = staleDerivatives(mediaItem)
+			if mediaItem['original'] in identical:
+				identicalItems = identical[mediaItem['original']]
+				derivatives = mediaDerivatives(mediaItem)
+				for kind, fileName in list(fileNames.items()):
+					sourceName = sharedDerivative(mediaItem, kind, identicalItems)
+					key = (cachedContentDigest(mediaItem['original']), kind, derivatives[kind][1])
+					if sourceName is not None:
+						links.append((mediaItem, kind, sourceName))
+					elif key in sharedFileNames:
+						pendingLinks.append((mediaItem, kind, sharedFileNames[key]))
+					else:
+						sharedFileNames[key] = fileName
+						continue
+					del fileNames[kind]
+			if len(fileNames) == 0:
+				continue
+			if argDryRun:
+				for fileName in fileNames.values():
+					logI('Created "{0}"'.format(fileName))
+			elif mediaItem['type'] == 'Image':
+				imageJobs.append((mediaItem, fileNames))
+			elif mediaItem['type'] == 'Video':
+				# Still frames need to decode just the beginning of the video,
+				# they are not blocked by long transcoding this way
+				stillFileNames = { kind: fileNames[kind] for kind in fileNames.keys() if kind in [ 'thumbnail', 'poster' ] }
+				transcodeFileNames = { kind: fileNames[kind] for kind in fileNames.keys() if kind not in stillFileNames.keys() }
+				for jobFileNames in [ stillFileNames, transcodeFileNames ]:
+					if len(jobFileNames) > 0:
+						toolJobs.append((mediaItem, jobFileNames))
+			else:
+				toolJobs.append((mediaItem, fileNames))
+
+	# Images are processed in batches to not flood process pool with tiny jobs,
+	# but batches are still small enough to keep all Pillow workers busy
+	batchSize = max(1, min(MaxImageBatchSize, len(imageJobs) // (4 * PillowWorkers)))
+	imageBatches = [ imageJobs[index:index + batchSize] for index in range(0, len(imageJobs), batchSize) ]
+
+	# Run all jobs and record created files in manifest
+	if argDryRun:
+		linkDerivatives(links + pendingLinks)
+	else:
+		openJournal()
+		try:
+			linkedGalleryIds = linkDerivatives(links)
+			streamGalleryIds = asyncio.run(runMediaJobs(imageBatches, toolJobs, onGalleryThumbnailsDone))
+			# Derivatives of identical originals are linked once created,
+			# failed jobs leave them stale for next run
+			links = [ (mediaItem, kind, sharedDerivative(mediaItem, kind, identical[mediaItem['original']])) for mediaItem, kind, sourceName in pendingLinks ]
+			linkedGalleryIds |= linkDerivatives([ link for link in links if link[2] is not None ])
+			# Galleries are published again with thumbnails in sprite sheets,
+			# with linked thumbnails and with video streams finished after
+			# their thumbnails
+			spritesInIds = { galleryId: galleriesIn[galleryId] for galleryId in galleryIds }
+			for galleryId in sorted(linkedGalleryIds | streamGalleryIds | set(generateThumbnailSprites(spritesInIds))):
+				onGalleryThumbnailsDone(galleryId)
+			removeUnusedSprites(spritesInIds)
+		finally:
+			storeManifest()
+			closeJournal()
 
 	logI('<<<<< Creating media metadata files finished.')
 
+#*** Unreferenced media
+# Files in site metadata galleries folder not referenced by any item (removed
+# galleries and items, derivatives not used anymore and leftovers of killed
+# runs) are deleted with argument --delete-unreferenced-media. Deleting holds
+# exclusive lock of site metadata folder, media generation and manifest writers
+# hold shared one.
+
+siteMetaDataLocked = False # Lock is held by this run
+
+@contextlib.contextmanager
+def siteMetaDataLock(operation):
+	# operation: fcntl.LOCK_SH or fcntl.LOCK_EX, optionally with fcntl.LOCK_NB
+	# Yields False when non-blocking lock is held by other run. Nested lock
+	# keeps the one already held, flock() would wait for this run otherwise.
+	global siteMetaDataLocked
+	if argDryRun or siteMetaDataLocked:
+		yield True
+		return
+	filePath = publishedPath(os.path.join(SiteMetaData, LockFile))
+	os.makedirs(os.path.dirname(filePath), mode = 0o755, exist_ok = True)
+	with open(filePath, 'a') as f:
+		try:
+			fcntl.flock(f.fileno(), operation)
+		except BlockingIOError:
+			yield False
+			return
+		try:
+			siteMetaDataLocked = True
+			yield True
+		finally:
+			siteMetaDataLocked = False
+			fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def listedItemIds():
+	# Returns dictionary
+	#     Key: gallery ID
+	#     Value: set of IDs of items in site data folder now
+	# Items added after the scan (by other run) are not deleted this way
+	with os.scandir(os.path.join(SiteData, Galleries)) as entries:
+		galleryNames = [ entry.name for entry in entries if entry.is_dir() ]
+	def listGallery(galleryName):
+		with os.scandir(os.path.join(SiteData, Galleries, galleryName)) as entries:
+			return set([ mediaId(os.path.splitext(entry.name)[0]) for entry in entries if entry.is_file() ])
+	itemIds = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+		for galleryName, listedIds in zip(galleryNames, executor.map(listGallery, galleryNames)):
+			itemIds.setdefault(mediaId(galleryName), set()).update(listedIds)
+	return itemIds
+
+def unreferencedMedia(galleriesIn, itemIds):
+	# itemIds: see listedItemIds()
+	# Returns array of unreferenced file and folder names, whole folders of
+	# removed galleries included
+	galleriesPath = os.path.join(SiteMetaData, Galleries)
+	if not os.path.isdir(publishedPath(galleriesPath)):
+		return []
+	expected = set()
+	for galleryId in galleriesIn.keys():
+		for mediaItem in galleriesIn[galleryId].values():
+			expected.update([ fileName for fileName, params in mediaDerivatives(mediaItem).values() ])
+	def galleryUnreferenced(galleryId):
+		galleryPath = os.path.join(galleriesPath, galleryId)
+		if galleryId not in itemIds:
+			return [ galleryPath ]
+		fileNames = []
+		with os.scandir(publishedPath(galleryPath)) as entries:
+			for entry in entries:
+				fileName = os.path.join(galleryPath, entry.name)
+				if entry.name == ThumbnailSprites or fileName in expected:
+					continue # Unused sprite sheets are removed by media generation
+				itemId = derivativeItemId(entry.name)
+				# Derivatives of items added after the scan are unknown, they are kept
+				if entry.name.startswith('.tmp.') or itemId not in itemIds[galleryId] or itemId in galleriesIn.get(galleryId, {}):
+					fileNames.append(fileName)
+		return fileNames
+	with os.scandir(publishedPath(galleriesPath)) as entries:
+		galleryIds = sorted([ entry.name for entry in entries if entry.is_dir() ])
+	with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+		return sorted([ fileName for fileNames in executor.map(galleryUnreferenced, galleryIds) for fileName in fileNames ])
+
+def fileLinks(path):
+	# Returns array of (device, inode, links count, size) tuples of file or
+	# files in folder
+	if not os.path.isdir(path) or os.path.islink(path):
+		stat = os.lstat(path)
+		return [ (stat.st_dev, stat.st_ino, stat.st_nlink, stat.st_size) ]
+	links = []
+	for folderName, subfolderNames, fileNames in os.walk(path):
+		for fileName in fileNames:
+			links += fileLinks(os.path.join(folderName, fileName))
+	return links
+
+def reclaimedBytes(paths):
+	# Returns number of bytes freed by removing given files and folders, hard
+	# linked files (see linkDerivative()) are freed with their last link only
+	# Key: (device, inode)
+	# Value: number of removed links
+	removedLinks = {}
+	sizes = {}
+	with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+		for links in executor.map(fileLinks, paths):
+			for device, inode, linksCount, size in links:
+				removedLinks[(device, inode)] = removedLinks.get((device, inode), 0) + 1
+				sizes[(device, inode)] = (linksCount, size)
+	return sum([ size for key, (linksCount, size) in sizes.items() if removedLinks[key] >= linksCount ])
+
+def deleteUnreferencedMedia(galleriesIn):
+	global manifestChanged
+	logI('')
+	logI('>>>>> Deleting unreferenced media files started...')
+	with siteMetaDataLock(fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+		if not locked:
+			logW('Media files are being created by other run, nothing deleted')
+			return
+		wallStart = time.monotonic()
+		# Records created by other runs since the manifest was loaded
+		mergeManifest()
+		galleriesPath = os.path.join(SiteMetaData, Galleries)
+		itemIds = listedItemIds()
+		fileNames = unreferencedMedia(galleriesIn, itemIds)
+		documents = [ filePath for filePath in sorted(documentDigests.keys()) if os.path.dirname(filePath) == galleriesPath and os.path.basename(filePath).split('.')[0] not in itemIds ]
+		removedPaths = fileNames + [ fileName for filePath in documents for fileName in [ filePath ] + [ filePath + extension for extension in CompressedExtensions ] ]
+		removedPaths = [ path for path in removedPaths if os.path.lexists(publishedPath(path)) ]
+		freedBytes = reclaimedBytes([ publishedPath(path) for path in removedPaths ])
+		for fileName in fileNames:
+			logI('Removed "{0}"'.format(fileName))
+		if argDryRun:
+			for filePath in documents:
+				removeDocument(filePath)
+			logI('{0} files and folders would be removed, {1:.1f} MiB freed'.format(len(removedPaths), freedBytes / (1024 * 1024)))
+			logI('<<<<< Deleting unreferenced media files finished.')
+			return
+		failedCount = 0
+		with concurrent.futures.ThreadPoolExecutor(max_workers = DeleteThreads) as executor:
+			# Removed in site metadata folder by syncStage() when staging
+			futures = { executor.submit(removeFile, fileName): fileName for fileName in fileNames }
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					future.result()
+				except Exception as ex:
+					failedCount += 1
+					logE('Cannot remove "{0}" ({1})'.format(futures[future], str(ex)))
+		removedFolders = tuple([ fileName + os.sep for fileName in fileNames ])
+		for fileName in [ fileName for fileName in manifest.keys() if fileName in fileNames or fileName.startswith(removedFolders) ]:
+			del manifest[fileName]
+			manifestChanged = True
+		for filePath in documents:
+			removeDocument(filePath)
+		# Prune gallery folders left empty (by next run when staging)
+		for galleryId in sorted(itemIds.keys()):
+			for folderPath in [ os.path.join(galleriesPath, galleryId, ThumbnailSprites), os.path.join(galleriesPath, galleryId) ]:
+				if os.path.isdir(publishedPath(folderPath)) and len(os.listdir(publishedPath(folderPath))) == 0:
+					removeFile(folderPath)
+					logI('Removed empty folder "{0}"'.format(folderPath))
+		storeManifest()
+	logI('Deleted {0} files and folders ({1} failed), {2:.1f} MiB freed in {3:.1f} s'.format(len(removedPaths) - failedCount, failedCount, freedBytes / (1024 * 1024), time.monotonic() - wallStart))
+	logI('<<<<< Deleting unreferenced media files finished.')
+
 def displayStatisticalData(galleriesIn, galleriesOut, galleryNames):
 	logI('')
 	logI('New galleries (*):')
@@ -764,7 +2767,7 @@ def displayStatisticalData(galleriesIn, galleriesOut, galleryNames):
 		filesCount = 0
 		for itemId in galleriesOut[galleryId].keys():
 			filesCount += len(galleriesOut[galleryId][itemId])
-		logI('    "{0}" ({1} items / {2} files)'.format(galleryNames[galleryId], str(itemsCount), str(filesCount)))
+		logI('    "{0}" ({1} items / {2} files)'.format(galleryNames.get(galleryId, galleryId), str(itemsCount), str(filesCount)))
 
 	logI('')
 	logI('Deleted items in existing galleries (**):')
@@ -783,8 +2786,559 @@ def displayStatisticalData(galleriesIn, galleriesOut, galleryNames):
 
 	logI('')
 	logI('*) RUN script with any combination of arguments ({0}, {1}, {2}) to update site metadata.'.format(ArgRss, ArgJson, ArgMedia))
-	# TODO: Add script argument to help clean
-	logI('**) DELETE files/folders manually from "{0}"'.format(os.path.join(os.getcwd(), SiteMetaData, Galleries)))
+	logI('**) RUN script with argument {0} to delete files/folders from "{1}"'.format(ArgDelete, os.path.join(os.getcwd(), SiteMetaData, Galleries)))
+
+def generateSiteMetaData(galleriesIn, galleriesOut, galleryNames, galleryIds):
+	# Generates outputs requested by arguments, gallery pages and media are
+	# generated only for galleries with given IDs
+	if argRss:
+		with runReport.phase('rss'):
+			generateRss(galleriesIn, galleriesOut, galleryNames)
+	if argJson:
+		# Together with media generation only items with thumbnails
+		# are published, the rest is published as soon as their
+		# thumbnails are created and all of them when media are done
+		with runReport.phase('json'):
+			generateJson(galleriesIn, galleriesOut, galleryNames, argMedia and not argDryRun, galleryIds)
+	storeManifest() # Digests of generated documents
+	if argMedia:
+		def onGalleryThumbnailsDone(galleryId):
+			if argJson:
+				generateJson_Gallery(galleriesIn, galleryNames, galleryId, True)
+				generateJson_GalleriesList(galleriesIn, galleryNames, True)
+		with runReport.phase('media'), siteMetaDataLock(fcntl.LOCK_SH):
+			generateMedia(galleriesIn, galleriesOut, galleryNames, onGalleryThumbnailsDone, galleryIds)
+		if argJson and not argDryRun:
+			# Items with failed thumbnails are published too, same as
+			# without media generation
+			with runReport.phase('json'):
+				for galleryId in sorted(galleriesIn.keys() if galleryIds is None else galleryIds):
+					readyIds = galleryReadyItemIds(galleryId, galleriesIn[galleryId])
+					for itemId in sorted(galleriesIn[galleryId].keys()):
+						if itemId not in readyIds:
+							logW('Published without thumbnail "{0}"'.format(galleriesIn[galleryId][itemId]['original']))
+				generateJson_Galleries(galleriesIn, galleriesOut, galleryNames, False, galleryIds)
+			storeManifest()
+	if argDelete:
+		if not argJson:
+			logW('Published pages may refer to deleted files until run with {0}'.format(ArgJson))
+		with runReport.phase('delete'):
+			deleteUnreferencedMedia(galleriesIn)
+	storeProbeCache()
+	if argStage is not None:
+		with runReport.phase('sync'):
+			syncStage()
+	if not argDryRun:
+		logI('')
+		runReport.store()
+		syncStage() # Run report
+
+#***** Local staging
+# With argument --stage the script runs in local staging folder. Site data and
+# all other web root entries except site metadata are linked there, state files
+# are copied from site metadata folder. All outputs are written locally and
+# pushed to site metadata folder by syncStage() at the end of the run.
+
+stageRoot = None # Absolute path of staging folder or None when not staging
+webRoot = None # Absolute path of web root when staging
+stageRemoved = set() # Removed files and folders in site metadata to remove when syncing
+stagePulled = {} # Key: state file copied from site metadata, value: SHA-1 digest of its content
+originalCache = None # OriginalCache when staging
+
+def publishedPath(path):
+	# Returns path in web root for path relative to working folder
+	if stageRoot is None:
+		return path
+	return os.path.join(webRoot, path)
+
+def stagedOrPublishedPath(path):
+	# Returns path of staged file, path in web root when the file is not staged
+	if stageRoot is None or os.path.lexists(path):
+		return path
+	return publishedPath(path)
+
+def fileDigest(filePath):
+	with open(filePath, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def copyOriginal(original, filePath):
+	# Runs in fetch thread
+	shutil.copyfile(original, temporaryFileName(filePath))
+	os.replace(temporaryFileName(filePath), filePath)
+	return filePath
+
+class OriginalCache:
+	# Local copies of originals named by their fingerprints. Copies are pinned
+	# from prefetch until all jobs using them are finished, least recently used
+	# unpinned copies are evicted when the cache exceeds its limit. Only copying
+	# runs in threads, bookkeeping runs in event loop.
+	def __init__(self, folder, maxBytes):
+		self.folder = folder
+		self.maxBytes = maxBytes
+		self.entries = OrderedDict() # Key: copy name, value: bytes, least recently used first
+		self.bytes = 0
+		self.pinned = {} # Key: copy name, value: number of jobs using the copy
+		self.fetches = {} # Key: original file name, value: future of local file name
+		self.changed = None # asyncio.Condition notified on prefetch progress and released copies
+		os.makedirs(folder, mode = 0o755, exist_ok = True)
+		copies = []
+		for name in os.listdir(folder):
+			filePath = os.path.join(folder, name)
+			if name.startswith('.tmp.'):
+				os.remove(filePath)
+				continue
+			stat = os.stat(filePath)
+			copies.append((stat.st_mtime, name, stat.st_size))
+		for mtime, name, size in sorted(copies):
+			self.entries[name] = size
+			self.bytes += size
+	def copyName(self, mediaItem):
+		return cachedFingerprint(mediaItem['original']) + os.path.splitext(mediaItem['original'])[1].lower()
+	def makeRoom(self, name, size, batchNames):
+		# batchNames: names of copies already pinned for the batch being fetched
+		# Returns True when copy is cached or fits to cache after eviction
+		if name in self.entries:
+			return True
+		for victim in list(self.entries.keys()):
+			if self.bytes + size <= self.maxBytes:
+				break
+			if victim in self.pinned:
+				continue
+			self.bytes -= self.entries.pop(victim)
+			os.remove(os.path.join(self.folder, victim))
+			logD('Evicted "{0}" from original cache'.format(victim))
+		# Batch bigger than whole cache is allowed when nothing else is cached,
+		# its own copies are not released before it is fetched whole
+		return self.bytes + size <= self.maxBytes or all([ entry in batchNames for entry in self.entries.keys() ])
+	async def prefetch(self, batches, executor):
+		# batches: array of arrays of (mediaItem, fileNames) tuples in order of
+		#     expected processing
+		# Batch waits for all its copies, so copies of one batch are fetched
+		# before copies of the next one. Otherwise copies pinned by partially
+		# fetched batches could fill the cache and nothing would be released.
+		loop = asyncio.get_running_loop()
+		self.changed = asyncio.Condition()
+		self.fetches = {} # Futures of previous run (in watch mode) belong to closed event loop
+		uses = {}
+		for batch in batches:
+			for mediaItem, fileNames in batch:
+				uses[mediaItem['original']] = uses.get(mediaItem['original'], 0) + 1
+		for batch in batches:
+			batchNames = set()
+			for mediaItem, fileNames in batch:
+				await self.prefetchOriginal(mediaItem, uses, batchNames, loop, executor)
+	async def prefetchOriginal(self, mediaItem, uses, batchNames, loop, executor):
+		original = mediaItem['original']
+		name = self.copyName(mediaItem)
+		if original in self.fetches:
+			batchNames.add(name)
+			return
+		size = originalSize(mediaItem)
+		async with self.changed:
+			# Cache full of pinned copies waits for jobs to finish
+			await self.changed.wait_for(lambda: self.makeRoom(name, size, batchNames))
+			self.pinned[name] = self.pinned.get(name, 0) + uses[original]
+			batchNames.add(name)
+			filePath = os.path.join(self.folder, name)
+			if name in self.entries:
+				self.entries.move_to_end(name)
+				self.fetches[original] = loop.create_future()
+				self.fetches[original].set_result(filePath)
+			else:
+				self.entries[name] = size
+				self.bytes += size
+				self.fetches[original] = loop.run_in_executor(executor, copyOriginal, original, filePath)
+			self.changed.notify_all()
+	async def localOriginal(self, mediaItem):
+		# Returns file name of local copy, original when it cannot be copied
+		original = mediaItem['original']
+		async with self.changed:
+			await self.changed.wait_for(lambda: original in self.fetches)
+		try:
+			return await self.fetches[original]
+		except Exception as ex:
+			logW('Cannot copy "{0}" to original cache ({1})'.format(original, str(ex)))
+			name = self.copyName(mediaItem)
+			if name in self.entries and not os.path.isfile(os.path.join(self.folder, name)):
+				self.bytes -= self.entries.pop(name)
+			return original
+	async def release(self, mediaItem):
+		name = self.copyName(mediaItem)
+		async with self.changed:
+			self.pinned[name] -= 1
+			if self.pinned[name] == 0:
+				del self.pinned[name]
+			if name in self.entries:
+				self.entries.move_to_end(name)
+				with contextlib.suppress(OSError):
+					os.utime(os.path.join(self.folder, name)) # Recently used for next runs
+			self.changed.notify_all()
+
+def prepareStage(folder):
+	# Prepares staging folder and makes it working folder
+	global stageRoot, webRoot, originalCache
+	webRoot = os.getcwd()
+	stageRoot = os.path.abspath(folder)
+	logI('Staging in folder "{0}"'.format(stageRoot))
+	os.makedirs(stageRoot, mode = 0o755, exist_ok = True)
+	# Outputs left by interrupted run are dropped, they were not recorded in
+	# site metadata folder
+	stageMetaData = os.path.join(stageRoot, SiteMetaData)
+	if os.path.isdir(stageMetaData):
+		shutil.rmtree(stageMetaData)
+	os.makedirs(stageMetaData, mode = 0o755)
+	for name in sorted(os.listdir(webRoot)):
+		target = os.path.join(webRoot, name)
+		if name == SiteMetaData or name.startswith('.') or target == stageRoot:
+			continue
+		link = os.path.join(stageRoot, name)
+		if os.path.islink(link) and os.readlink(link) == target:
+			continue
+		if os.path.lexists(link):
+			os.remove(link)
+		os.symlink(target, link)
+	for name in [ ProbeCacheFile, ManifestFile, JournalFile ]:
+		filePath = os.path.join(SiteMetaData, name)
+		if os.path.isfile(os.path.join(webRoot, filePath)):
+			shutil.copyfile(os.path.join(webRoot, filePath), os.path.join(stageRoot, filePath))
+			stagePulled[filePath] = fileDigest(os.path.join(stageRoot, filePath))
+	originalCache = OriginalCache(os.path.join(stageRoot, StageOriginals), StageCacheMaxBytes)
+	os.chdir(stageRoot)
+
+def pushStagedFile(filePath):
+	# Runs in sync thread, staged file is removed when pushed
+	targetPath = publishedPath(filePath)
+	os.makedirs(os.path.dirname(targetPath), mode = 0o755, exist_ok = True)
+	shutil.copyfile(filePath, temporaryFileName(targetPath))
+	os.replace(temporaryFileName(targetPath), targetPath)
+	size = os.path.getsize(filePath)
+	if filePath not in stagePulled:
+		os.remove(filePath)
+	return size
+
+def stagedLinkSource(filePath):
+	# Returns file name the staged derivative (or file in derivative folder) is
+	# hard linked to, see linkDerivative(), None for other files
+	for fileName, name in [ (filePath, None), (os.path.dirname(filePath), os.path.basename(filePath)) ]:
+		record = manifest.get(fileName)
+		if record is not None and 'link' in record:
+			return record['link'] if name is None else os.path.join(record['link'], name)
+	return None
+
+def pushStagedLink(filePath, sourceName):
+	# Runs in sync thread, hard link is created in site metadata folder
+	# instead of pushing another copy of the same bytes
+	# Returns None when linked, number of pushed bytes when copied
+	targetPath = publishedPath(filePath)
+	try:
+		os.makedirs(os.path.dirname(targetPath), mode = 0o755, exist_ok = True)
+		removeFile(temporaryFileName(targetPath))
+		os.link(publishedPath(sourceName), temporaryFileName(targetPath))
+		os.replace(temporaryFileName(targetPath), targetPath)
+	except OSError:
+		# Source is not published (e.g. failed push) or file system does not
+		# support hard links
+		removeFile(temporaryFileName(targetPath))
+		return pushStagedFile(filePath)
+	os.remove(filePath)
+	return None
+
+def syncStage():
+	# Pushes files staged by this run to site metadata folder. Removed files
+	# go first, then media files, hard links of media files to them,
+	# documents referencing them and state files at last. Unchanged state
+	# files are not pushed.
+	global stageRemoved
+	if stageRoot is None or argDryRun:
+		return
+	wallStart = time.monotonic()
+	removedCount = 0
+	for filePath in sorted(stageRemoved):
+		# Replaced folders are removed too (e.g. video streams), replaced
+		# files are overwritten by push
+		if not os.path.lexists(filePath) or os.path.isdir(filePath):
+			if os.path.lexists(publishedPath(filePath)):
+				removedCount += 1
+			removeFile(publishedPath(filePath))
+	stageRemoved = set()
+	# Manifest is stored again with changes of other runs made since it was
+	# pulled and pushed under the same lock (see storeManifest())
+	with siteMetaDataLock(fcntl.LOCK_SH):
+		mergeManifest()
+		storeManifest()
+		groups = [ [], [], [], [] ] # Media files, linked media files, documents, state files
+		unchangedCount = 0
+		for folderName, subfolderNames, fileNames in os.walk(SiteMetaData):
+			for name in fileNames:
+				filePath = os.path.join(folderName, name)
+				if name.startswith('.tmp.'):
+					continue
+				if filePath in stagePulled:
+					digest = fileDigest(filePath)
+					if digest == stagePulled[filePath]:
+						unchangedCount += 1
+						continue
+					stagePulled[filePath] = digest
+				if folderName == SiteMetaData and name.startswith('.'):
+					groups[3].append(filePath)
+				elif os.path.dirname(folderName) == SiteMetaData or folderName == SiteMetaData:
+					groups[2].append(filePath)
+				elif stagedLinkSource(filePath) is not None:
+					# Copy would split hard link, it is linked after its source
+					# is pushed
+					groups[1].append(filePath)
+				else:
+					groups[0].append(filePath)
+		pushedCount = 0
+		pushedBytes = 0
+		linkedCount = 0
+		failedCount = 0
+		with concurrent.futures.ThreadPoolExecutor(max_workers = StageSyncThreads) as executor:
+			for groupIndex, group in enumerate(groups):
+				if groupIndex == 1:
+					futures = { executor.submit(pushStagedLink, filePath, stagedLinkSource(filePath)): filePath for filePath in sorted(group) }
+				else:
+					futures = { executor.submit(pushStagedFile, filePath): filePath for filePath in sorted(group) }
+				for future in concurrent.futures.as_completed(futures):
+					try:
+						fileBytes = future.result()
+						if fileBytes is None:
+							linkedCount += 1
+							logD('Linked "{0}"'.format(futures[future]))
+							continue
+						pushedBytes += fileBytes
+						pushedCount += 1
+						logD('Pushed "{0}"'.format(futures[future]))
+						if futures[future] == os.path.join(SiteMetaData, ManifestFile):
+							manifestPublished()
+					except Exception as ex:
+						failedCount += 1
+						logE('Cannot push "{0}" to "{1}" ({2})'.format(futures[future], publishedPath(futures[future]), str(ex)))
+	logI('Synced to "{0}": {1} files pushed ({2:.1f} MiB), {3} linked, {4} removed, {5} unchanged, {6} failed in {7:.1f} s'.format(
+		os.path.join(webRoot, SiteMetaData), pushedCount, pushedBytes / (1024 * 1024), linkedCount, removedCount, unchangedCount, failedCount, time.monotonic() - wallStart))
+
+#***** Watch mode
+# With argument --watch the script keeps running after the first run with
+# gallery model in memory. Touched gallery folders are collected from file
+# system events (polling when events are not available) and regenerated once
+# the changes settle, so a big upload is processed by one update.
+
+# inotify constants, see /usr/include/linux/inotify.h
+InotifyModify = 0x00000002
+InotifyCloseWrite = 0x00000008
+InotifyMovedFrom = 0x00000040
+InotifyMovedTo = 0x00000080
+InotifyCreate = 0x00000100
+InotifyDelete = 0x00000200
+InotifyQueueOverflow = 0x00004000
+InotifyIgnored = 0x00008000
+InotifyOnlyDir = 0x01000000
+InotifyIsDir = 0x40000000
+InotifyNonBlock = 0o4000
+InotifyCloseOnExec = 0o2000000
+InotifyEventHeader = struct.Struct('iIII') # Watch descriptor, mask, cookie, name length
+InotifyGalleriesEvents = InotifyCreate | InotifyDelete | InotifyMovedFrom | InotifyMovedTo | InotifyOnlyDir
+InotifyGalleryEvents = InotifyGalleriesEvents | InotifyModify | InotifyCloseWrite
+
+class InotifyWatcher:
+	# Watches galleries folder and every gallery folder (inotify watches are
+	# not recursive), watches of gallery folders follow their creation,
+	# renaming and removal
+	def __init__(self, galleriesPath):
+		self.galleriesPath = galleriesPath
+		self.libc = ctypes.CDLL(None, use_errno = True)
+		self.fd = self.libc.inotify_init1(InotifyNonBlock | InotifyCloseOnExec)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+		self.watches = {} # Key: watch descriptor, value: gallery folder name (None for galleries folder)
+		try:
+			self.addWatch(None)
+			for galleryName in self.galleryNames():
+				self.addWatch(galleryName)
+		except OSError:
+			self.close()
+			raise
+	def galleryNames(self):
+		with os.scandir(self.galleriesPath) as entries:
+			return [ entry.name for entry in entries if entry.is_dir() ]
+	def addWatch(self, galleryName):
+		if galleryName is None:
+			path, events = self.galleriesPath, InotifyGalleriesEvents
+		else:
+			path, events = os.path.join(self.galleriesPath, galleryName), InotifyGalleryEvents
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), events)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+		self.watches[wd] = galleryName # Renamed folder keeps its watch descriptor
+	def removeWatch(self, galleryName):
+		for wd in [ wd for wd, name in self.watches.items() if name == galleryName ]:
+			self.libc.inotify_rm_watch(self.fd, wd)
+			del self.watches[wd]
+	def changes(self, timeout):
+		# Returns set of names of touched gallery folders, empty set when
+		# nothing changed within timeout (seconds, None waits for changes)
+		touched = set()
+		readable, writable, failed = select.select([ self.fd ], [], [], timeout)
+		if len(readable) == 0:
+			return touched
+		try:
+			data = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return touched
+		offset = 0
+		while offset < len(data):
+			wd, mask, cookie, length = InotifyEventHeader.unpack_from(data, offset)
+			offset += InotifyEventHeader.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+			offset += length
+			if mask & InotifyQueueOverflow:
+				# Events were lost, every gallery is scanned again
+				logW('Too many file system events, all galleries will be updated')
+				galleryNames = self.galleryNames()
+				touched.update(galleryNames)
+				touched.update([ name for name in self.watches.values() if name is not None ])
+				for galleryName in [ name for name in galleryNames if name not in self.watches.values() ]:
+					with contextlib.suppress(OSError):
+						self.addWatch(galleryName)
+			elif mask & InotifyIgnored:
+				self.watches.pop(wd, None)
+			elif wd in self.watches and self.watches[wd] is None:
+				# Gallery folder created, renamed or removed
+				if mask & InotifyIsDir:
+					if mask & (InotifyCreate | InotifyMovedTo):
+						try:
+							self.addWatch(name)
+						except OSError as ex:
+							logW('Cannot watch gallery folder "{0}" ({1})'.format(name, str(ex)))
+					else:
+						self.removeWatch(name)
+					touched.add(name)
+			elif wd in self.watches:
+				touched.add(self.watches[wd])
+		return touched
+	def close(self):
+		os.close(self.fd)
+
+class PollingWatcher:
+	# Compares listings of gallery folders every WatchPollInterval seconds,
+	# for file systems without inotify events
+	def __init__(self, galleriesPath):
+		self.galleriesPath = galleriesPath
+		self.listings = self.scan()
+		self.nextPoll = time.monotonic() + WatchPollInterval
+	def scanGallery(self, galleryName):
+		# Returns frozenset of (file name, size, mtime) tuples, None for removed folder
+		try:
+			with os.scandir(os.path.join(self.galleriesPath, galleryName)) as entries:
+				return frozenset([ (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries if entry.is_file() ])
+		except OSError:
+			return None
+	def scan(self):
+		# Returns dictionary
+		#     Key: gallery folder name
+		#     Value: listing of gallery folder, see scanGallery()
+		with os.scandir(self.galleriesPath) as entries:
+			galleryNames = [ entry.name for entry in entries if entry.is_dir() ]
+		with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+			listings = dict(zip(galleryNames, executor.map(self.scanGallery, galleryNames)))
+		return { galleryName: listing for galleryName, listing in listings.items() if listing is not None }
+	def changes(self, timeout):
+		# Same as InotifyWatcher.changes()
+		delay = max(0, self.nextPoll - time.monotonic())
+		if timeout is not None and timeout < delay:
+			time.sleep(timeout)
+			return set()
+		time.sleep(delay)
+		self.nextPoll = time.monotonic() + WatchPollInterval
+		listings = self.scan()
+		touched = set([ galleryName for galleryName in listings.keys() | self.listings.keys() if listings.get(galleryName) != self.listings.get(galleryName) ])
+		self.listings = listings
+		return touched
+	def close(self):
+		pass
+
+def createWatcher():
+	# Watcher is created before the first run, changes made during the run
+	# are not lost this way
+	galleriesPath = os.path.join(SiteData, Galleries)
+	if not WatchPolling:
+		try:
+			watcher = InotifyWatcher(galleriesPath)
+			logD('Watching {0} folders for file system events'.format(len(watcher.watches)))
+			return watcher
+		except (OSError, AttributeError) as ex:
+			# AttributeError: C library without inotify functions
+			logW('Cannot watch folder "{0}" for file system events ({1}), polling it instead'.format(galleriesPath, str(ex)))
+	return PollingWatcher(galleriesPath)
+
+def rescanGalleries(galleriesIn, galleryNames, touchedNames):
+	# Updates galleriesIn and galleryNames (see main) for touched gallery folders
+	# Returns array of IDs of touched galleries that still exist
+	galleryIds = set()
+	scannedNames = sorted([ galleryName for galleryName in touchedNames if os.path.isdir(os.path.join(SiteData, Galleries, galleryName)) ])
+	for galleryName in sorted(touchedNames):
+		galleryId = mediaId(galleryName)
+		if galleryName not in scannedNames and galleryNames.get(galleryId) == galleryName:
+			logI('Gallery "{0}" removed'.format(galleryName))
+			del galleriesIn[galleryId]
+			readyItems.pop(galleryId, None)
+			del galleryNames[galleryId]
+		# Probe cache records of removed files are forgotten when stored
+		galleryPrefix = os.path.join(SiteData, Galleries, galleryName) + os.sep
+		probeCacheUsed.difference_update([ filePath for filePath in probeCacheUsed if filePath.startswith(galleryPrefix) ])
+	with concurrent.futures.ThreadPoolExecutor(max_workers = ScanThreads) as executor:
+		scans = [ executor.submit(scanGallery, mediaId(galleryName), galleryName) for galleryName in scannedNames ]
+		for galleryName, scan in zip(scannedNames, scans):
+			try:
+				addScannedGallery(galleriesIn, galleryNames, galleryName, scan.result())
+				galleryIds.add(mediaId(galleryName))
+				logI('Gallery "{0}" scanned'.format(galleryName))
+			except OSError as ex:
+				# Files are still being moved, next change triggers new scan
+				logW('Cannot scan gallery "{0}" ({1})'.format(galleryName, str(ex)))
+	return sorted(galleryIds)
+
+def watchGalleries(watcher, galleriesIn, galleryNames):
+	# Regenerates touched galleries when no change came for WatchSettleTime
+	# seconds, or WatchMaxDelay seconds after the first change at latest
+	global runReport
+	logI('')
+	logI('Watching "{0}" for changes, press Ctrl+C to stop...'.format(os.path.join(os.getcwd(), SiteData, Galleries)))
+	touchedNames = set()
+	firstChange = None
+	lastChange = None
+	try:
+		while True:
+			timeout = None
+			if len(touchedNames) > 0:
+				timeout = max(0, min(lastChange + WatchSettleTime, firstChange + WatchMaxDelay) - time.monotonic())
+			changedNames = watcher.changes(timeout)
+			now = time.monotonic()
+			if len(changedNames) > 0:
+				if len(touchedNames) == 0:
+					firstChange = now
+				touchedNames.update(changedNames)
+				lastChange = now
+				if now < firstChange + WatchMaxDelay:
+					continue
+			if len(touchedNames) == 0 or now < min(lastChange + WatchSettleTime, firstChange + WatchMaxDelay):
+				continue
+			logI('')
+			logI('>>>>> Updating {0} changed galleries...'.format(len(touchedNames)))
+			runReport = RunReport()
+			try:
+				with runReport.phase('scan'):
+					galleryIds = rescanGalleries(galleriesIn, galleryNames, touchedNames)
+				galleriesOut = galleriesOutFromManifest()
+				generateSiteMetaData(galleriesIn, galleriesOut, galleryNames, galleryIds)
+			except Exception as ex:
+				logE('Updating galleries failed ({0})'.format(str(ex)))
+			touchedNames = set()
+	except KeyboardInterrupt:
+		clearProgress()
+		logI('Watching stopped')
+	finally:
+		watcher.close()
 
 #**********
 
@@ -793,6 +3347,9 @@ if __name__ == '__main__':
 	argRss = False
 	argJson = False
 	argMedia = False
+	argStage = None
+	argWatch = False
+	argDelete = False
 
 	firstArg = True
 	for arg in sys.argv:
@@ -821,6 +3378,18 @@ if __name__ == '__main__':
 			argJson = True
 			argMedia = True
 			continue
+		if arg == ArgVerbose:
+			LogDebugMessages = True
+			continue
+		if arg.startswith(ArgStage + '='):
+			argStage = arg[len(ArgStage) + 1:]
+			continue
+		if arg == ArgWatch:
+			argWatch = True
+			continue
+		if arg == ArgDelete:
+			argDelete = True
+			continue
 
 	toolsCheckResult = checkTools()
 	if toolsCheckResult != 0:
@@ -867,51 +3436,28 @@ if __name__ == '__main__':
 		# Value: gallery folder name (string)
 		galleryNames = {}
 
-		galleriesIn_Names = [name for name in sorted(os.listdir(os.path.join(SiteData, Galleries))) if os.path.isdir(os.path.join(SiteData, Galleries, name)) ]
-		for galleryName in galleriesIn_Names:
-			logD('In Gallery: ' + galleryName)
-			galleryId = mediaId(galleryName)
-			if galleryId in galleriesIn.keys():
-				logE('          : Gallery ID {0} already exists!'.format(galleryId))
-				logW('          : Gallery "{0}" will be unabailable in favor of "{1}"'.format(galleryNames[galleryId], galleryName))
-			galleryNames[galleryId] = galleryName
-			galleriesIn[galleryId] = {}
-			galleryPath = os.path.join(SiteData, Galleries, galleryName)
-			fileNames = [name for name in sorted(os.listdir(galleryPath)) if os.path.isfile(os.path.join(galleryPath, name)) ]
-			for fileName in fileNames:
-				logD('In    Item: ' + fileName)
-				mediaItem = convertOriginalToMediaItem(galleryId, galleryNames[galleryId], fileName)
-				if mediaItem['type'] == '':
-					logE('          : Ignored unsupported media type "{0}"'.format(fileName))
-				else:
-					itemId = mediaItem['id']
-					if itemId in galleriesIn[galleryId].keys():
-						logE('          : Gallery ID {0} already has item with ID {1}!'.format(galleryId, itemId))
-						logW('          : File "{0}" will be unabailable in favor of "{1}"'.format(galleryNames[galleryId]['original'], mediaItem['original']))
-					else:
-						galleriesIn[galleryId][itemId] = mediaItem
-
-		if os.path.isdir(os.path.join(SiteMetaData, Galleries)):
-			galleriesOut_Names = [name for name in sorted(os.listdir(os.path.join(SiteMetaData, Galleries))) if os.path.isdir(os.path.join(SiteMetaData, Galleries, name)) ]
-			for galleryName in galleriesOut_Names:
-				logD('Out Gallery: ' + galleryName)
-				galleryId = galleryName
-				if galleryId in galleriesOut.keys():
-					logE('          : Gallery ID {0} already exists!'.format(galleryId))
-					logW('          : Gallery "{0}" will be unabailable in favor of "{1}"'.format(galleryNames[galleryId], galleryName))
-				galleriesOut[galleryId] = {}
-				galleryPath = os.path.join(SiteMetaData, Galleries, galleryName)
-				fileNames = [name for name in sorted(os.listdir(galleryPath)) if os.path.isfile(os.path.join(galleryPath, name)) ]
-				for fileName in fileNames:
-					logD('Out    Item: ' + fileName)
-					#itemId = mediaId(os.path.splitext(fileName)[0])
-					itemId = re.sub(r'^([0-9]+)\..*$', r'\1', os.path.splitext(fileName)[0]) # File name starts with digits followed at least by a dot
-					if itemId not in galleriesOut[galleryId].keys():
-						galleriesOut[galleryId][itemId] = []
-					if fileName in galleriesOut[galleryId][itemId]:
-						logE('          : File "{0}" already registered for gallery ID {1} and item ID {2}!'.format(fileName, galleryId, itemId))
-						logW('          : Fix this inconsistency manually')
-					galleriesOut[galleryId][itemId].append(fileName)
+		if argStage is not None:
+			with runReport.phase('stage'):
+				prepareStage(argStage)
+
+		watcher = None
+		if argWatch:
+			if argRss or argJson or argMedia or argDelete:
+				watcher = createWatcher()
+			else:
+				logW('Argument {0} ignored, nothing to update without {1}, {2}, {3} or {4}'.format(ArgWatch, ArgRss, ArgJson, ArgMedia, ArgDelete))
+
+		with runReport.phase('scan'):
+			loadProbeCache()
+			galleriesIn, galleryNames = scanGalleriesIn()
+			storeProbeCache()
+
+		with runReport.phase('manifest'):
+			if not loadManifest():
+				adoptExistingDerivatives(galleriesIn)
+				storeManifest()
+			replayJournal()
+			galleriesOut = galleriesOutFromManifest()
 
 		logD('')
 		logD('Gallery items in folder "{0}":'.format(os.path.join(os.getcwd(), SiteData, Galleries)))
@@ -923,21 +3469,18 @@ if __name__ == '__main__':
 		logD('')
 		logD('Gallery items in folder "{0}":'.format(os.path.join(os.getcwd(), SiteMetaData, Galleries)))
 		for galleryId in sorted(galleriesOut.keys()):
-			logD('    "{0}"'.format(galleryNames[galleryId]))
+			logD('    "{0}"'.format(galleryNames.get(galleryId, galleryId)))
 			for itemId in sorted(galleriesOut[galleryId].keys()):
 				logD('        "{0}"'.format(itemId))
 				for itemFile in sorted(galleriesOut[galleryId][itemId]):
 					logD('            "{0}"'.format(itemFile))
 
-		if not argRss and not argMedia and not argJson:
+		if not argRss and not argMedia and not argJson and not argDelete:
 			displayStatisticalData(galleriesIn, galleriesOut, galleryNames)
 		else:
-			if argRss:
-				generateRss(galleriesIn, galleriesOut, galleryNames)
-			if argJson:
-				generateJson(galleriesIn, galleriesOut, galleryNames)
-			if argMedia:
-				generateMedia(galleriesIn, galleriesOut, galleryNames)
+			generateSiteMetaData(galleriesIn, galleriesOut, galleryNames, galleriesIn.keys())
+			if watcher is not None:
+				watchGalleries(watcher, galleriesIn, galleryNames)
 
 	except Exception as ex:
 		logE('Unhandled exception occured!!! ({0})'.format(str(ex)))